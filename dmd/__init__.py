@@ -7,3 +7,5 @@ from __future__ import (unicode_literals, absolute_import,
 import locale
 
 locale.setlocale(locale.LC_ALL, '')
+
+default_app_config = 'dmd.apps.DMDConfig'
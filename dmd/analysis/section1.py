@@ -14,6 +14,7 @@ from dmd.views.common import process_period_filter, process_entity_filter
 from dmd.models.Periods import MonthPeriod
 from dmd.models.Indicators import Indicator
 from dmd.models.DataRecords import DataRecord
+from dmd.models.Aggregates import DataAggregate
 
 logger = logging.getLogger(__name__)
 SECTION_ID = 1
@@ -67,7 +68,10 @@ def data_point_for(indicator, entity, period):
     dr = DataRecord.get_or_none(indicator=indicator,
                                 period=period, entity=entity,
                                 only_validated=True)
+    return data_point_from(dr, indicator, entity, period)
 
+
+def data_point_from(dr, indicator, entity, period):
     return {
         'has_data': bool(getattr(dr, 'id', False)),
         'id': getattr(dr, 'id', None),
@@ -84,20 +88,85 @@ def data_point_for(indicator, entity, period):
     }
 
 
-def get_timed_records(indicator, entity, periods):
-    years = sorted(set([period.year for period in periods]))
+class TimedRecordsMatrix(object):
+    """ validated records of an entity for indicators over whole years
+
+        Records of all the indicators for every month of the years
+        periods are in are fetched in a single query. Points and yearly
+        sums are then read from memory instead of with
+        `data_point_for` and `Indicator.year_data_for`. """
+
+    def __init__(self, entity, indicators, periods):
+        self.entity = entity
+        self.indicators = {indicator.slug: indicator
+                           for indicator in indicators}
+        self.years = sorted(set([period.year for period in periods]))
+
+        # all 12 months, as Indicator.year_data_for
+        self.year_periods = OrderedDict([
+            (year, MonthPeriod.all_from(MonthPeriod.get_or_create(year, 1),
+                                        MonthPeriod.get_or_create(year, 12)))
+            for year in self.years])
+        years_of = {period.id: year
+                    for year, year_periods in self.year_periods.items()
+                    for period in year_periods}
+
+        self.records = {}
+        self.summaries = {}
+        qs = DataRecord.objects.valid() \
+            .filter(entity=entity,
+                    indicator__in=self.indicators.keys()) \
+            .for_periods([period
+                          for year_periods in self.year_periods.values()
+                          for period in year_periods])
+        for dr in qs.iterator():
+            # avoids a query for each record's indicator
+            dr.indicator = self.indicators[dr.indicator_id]
+            self.records[(dr.indicator_id, dr.period_id)] = dr
+
+            key = (dr.indicator_id, years_of[dr.period_id])
+            nb, num, denom = self.summaries.get(key, (0, 0, 0))
+            self.summaries[key] = (nb + 1, num + dr.numerator,
+                                   denom + dr.denominator)
+
+        # same as `has_data` of Indicator.data_for: data for any period
+        self.with_data = set(
+            DataAggregate.objects.filter(entity=entity, level=entity.etype,
+                                         indicator__in=self.indicators.keys())
+                                 .values_list('indicator', flat=True)
+                                 .distinct())
+
+    def point_for(self, indicator, period):
+        return data_point_from(
+            self.records.get((indicator.slug, period.id)),
+            indicator, self.entity, period)
+
+    def year_data_for(self, indicator, year):
+        return indicator.aggregate_data_for(
+            self.entity, self.year_periods[year],
+            summary=self.summaries.get((indicator.slug, year), (0, 0, 0)),
+            has_data=indicator.slug in self.with_data)
+
+
+def get_timed_records(indicator, entity, periods, matrix=None):
+    if matrix is None:
+        matrix = TimedRecordsMatrix(entity=entity, indicators=[indicator],
+                                    periods=periods)
     return {
         'indicator': indicator,
         'periods': [period.to_tuple() for period in periods],
-        'points': [data_point_for(indicator, entity, period)
+        'points': [matrix.point_for(indicator, period)
                    for period in periods],
-        'year_elements': [indicator.year_data_for(entity, year)
-                          for year in years],
+        'year_elements': [matrix.year_data_for(indicator, year)
+                          for year in matrix.years],
     }
 
 
 def build_context(entity, periods, qs=None, *args, **kwargs):
-    qs = qs or Indicator.objects.all()
+    indicators = list(qs or Indicator.objects.all())
+    matrix = TimedRecordsMatrix(entity=entity, indicators=indicators,
+                                periods=periods)
     return OrderedDict([(indicator.slug,
-                         get_timed_records(indicator, entity, periods))
-                        for indicator in qs])
+                         get_timed_records(indicator, entity, periods,
+                                           matrix=matrix))
+                        for indicator in indicators])
@@ -15,7 +15,7 @@ from dmd.views.common import process_period_filter, process_entity_filter
 from dmd.models.Periods import MonthPeriod
 from dmd.models.Entities import Entity
 from dmd.models.Indicators import Indicator
-from dmd.caching import get_cached_data
+from dmd.caching import get_many_cached_data
 
 logger = logging.getLogger(__name__)
 SECTION_ID = 2
@@ -40,28 +40,30 @@ def view(request, entity_uuid=None, perioda_str=None, periodb_str=None,
     periods = MonthPeriod.all_from(context['perioda'], context['periodb'])
     context.update({'selected_periods': periods})
 
-    def cached_data_list(entity, periods, indicator):
-        return [get_cached_data('section2-arrivals',
-                                entity=entity,
-                                period=period,
-                                indicator=indicator)
-                for period in periods]
+    # all indicators x periods arrivals at once
+    indicators = list(Indicator.get_all_routine())
+    arrivals = get_many_cached_data(
+        'section2-arrivals', [{'entity': context['entity'],
+                               'period': period,
+                               'indicator': indicator}
+                              for indicator in indicators
+                              for period in periods])
 
     context.update({
         'section': text_type(SECTION_ID),
         'section_name': SECTION_NAME,
         'arrivals': OrderedDict(
-            [(indicator, cached_data_list(context['entity'],
-                                          periods, indicator))
-             for indicator in Indicator.get_all_routine()])
+            [(indicator, arrivals[index * len(periods):
+                                  (index + 1) * len(periods)])
+             for index, indicator in enumerate(indicators)])
     })
 
     # evolution graph
     cp = {
         'periods': [period.to_tuple() for period in periods],
-        'points': [get_cached_data('section2-points',
-                                   entity=context['entity'], period=period)
-                   for period in periods]
+        'points': get_many_cached_data(
+            'section2-points', [{'entity': context['entity'],
+                                 'period': period} for period in periods])
     }
     perioda = periods[0]
     periodb = periods[-1]
@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+from django.apps import AppConfig
+
+
+class DMDConfig(AppConfig):
+
+    name = 'dmd'
+    verbose_name = "DRC Malaria Dashboard"
+
+    def ready(self):
+        # imported for its side effect: registers the cache invalidation
+        # receivers (records_changed, request_started)
+        import dmd.caching  # noqa
@@ -6,9 +6,13 @@ from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 import logging
 
+import numpy
+from django.db.models import Count, Sum, Case, When, Value, IntegerField
+
 from dmd.models.Periods import MonthPeriod
 from dmd.models.DataRecords import DataRecord
 from dmd.models.Indicators import Indicator
+from dmd.models.Entities import Entity, EntityTree
 from dmd.templatetags.dmd import default_format_number, default_format_value
 
 logger = logging.getLogger(__name__)
@@ -31,8 +35,152 @@ def nb_expected_records_for(indicator, entity):
     return len(expected_entities_for(indicator, entity))
 
 
-def agg_arrival_for_period(indicator, entity, period):
-    return agg_arrival_for(indicator, entity, period.year, period.month)
+def arrival_data_for(nb_expected_reports, nb_arrived_reports,
+                     nb_prompt_reports):
+    return {
+        'nb_expected_reports': nb_expected_reports,
+        'nb_arrived_reports': nb_arrived_reports,
+        'nb_prompt_reports': nb_prompt_reports,
+        'completeness': nb_arrived_reports / nb_expected_reports,
+        'promptness': nb_prompt_reports / nb_expected_reports
+    }
+
+
+class CompletenessMatrix(object):
+    """ expected/arrived/prompt reports for indicators × entities × periods
+
+        All counts are computed from a single grouped query on DataRecord
+        and stored in dense numpy arrays indexed by the position of
+        the indicator, entity and period in the lists passed. """
+
+    def __init__(self, indicators, entities, periods):
+        self.indicators = list(indicators)
+        self.entities = list(entities)
+        self.periods = list(periods)
+
+        self.indicators_index = {indicator.slug: index for index, indicator
+                                 in enumerate(self.indicators)}
+        self.entities_index = {entity.uuid: index for index, entity
+                               in enumerate(self.entities)}
+        self.periods_index = {period.id: index for index, period
+                              in enumerate(self.periods)}
+
+        shape = (len(self.indicators), len(self.entities), len(self.periods))
+        # expected reports do not depend on the period
+        self.nb_expected = numpy.zeros(shape[:2], dtype=numpy.int64)
+        self.nb_arrived = numpy.zeros(shape, dtype=numpy.int64)
+        self.nb_prompt = numpy.zeros(shape, dtype=numpy.int64)
+        self.routine = numpy.array(
+            [indicator.collection_type == Indicator.ROUTINE
+             for indicator in self.indicators], dtype=bool)
+
+        if all(shape):
+            self.compute()
+
+    def contributions_for(self, collection_level, lineages):
+        """ positions of entities each source entity counts for
+
+            Mirrors `expected_entities_for`: an entity at the collection
+            level expects itself, entities above expect all their
+            descendants of the collection level type. """
+        collection_index = Entity.TYPES.keys().index(collection_level)
+        contributions = {}
+        for uuid, (etype, level, ancestors) in lineages.items():
+            targets = []
+            position = self.entities_index.get(uuid)
+            if position is not None and level == collection_index:
+                targets.append(position)
+            if etype == collection_level:
+                targets.extend(
+                    self.entities_index[ancestor]
+                    for ancestor in ancestors
+                    if ancestor in self.entities_index
+                    and lineages[ancestor][1] < collection_index)
+            if targets:
+                contributions[uuid] = targets
+        return contributions
+
+    def compute(self):
+        lineages = entities_lineages()
+
+        # which targets each source entity counts for, per indicator
+        levels = {}
+        contributions = []
+        for index, indicator in enumerate(self.indicators):
+            level = indicator.collection_level
+            if level not in levels:
+                levels[level] = self.contributions_for(level, lineages)
+            contributions.append(levels[level])
+            for targets in levels[level].values():
+                self.nb_expected[index, targets] += 1
+
+        rows = DataRecord.objects \
+            .filter(indicator__in=self.indicators_index.keys()) \
+            .for_periods(self.periods) \
+            .values('indicator', 'period', 'entity') \
+            .annotate(nb_arrived=Count('id'),
+                      nb_prompt=Sum(Case(
+                          When(arrival_status=DataRecord.ARRIVED_ON_TIME,
+                               then=Value(1)),
+                          default=Value(0),
+                          output_field=IntegerField())))
+
+        indexes = ([], [], [])
+        nb_arrived = []
+        nb_prompt = []
+        for row in rows:
+            iindex = self.indicators_index[row['indicator']]
+            targets = contributions[iindex].get(row['entity'], [])
+            for eindex in targets:
+                indexes[0].append(iindex)
+                indexes[1].append(eindex)
+                indexes[2].append(self.periods_index[row['period']])
+                nb_arrived.append(row['nb_arrived'])
+                nb_prompt.append(row['nb_prompt'])
+
+        numpy.add.at(self.nb_arrived, indexes, nb_arrived)
+        numpy.add.at(self.nb_prompt, indexes, nb_prompt)
+
+    def agg_arrival_for(self, indicator, entity, period):
+        iindex = self.indicators_index[indicator.slug]
+        eindex = self.entities_index[entity.uuid]
+        pindex = self.periods_index[period.id]
+        return arrival_data_for(
+            int(self.nb_expected[iindex, eindex]),
+            int(self.nb_arrived[iindex, eindex, pindex]),
+            int(self.nb_prompt[iindex, eindex, pindex]))
+
+    def avg_arrival_for(self, entity, period):
+        """ sum of all routine indicators in the matrix """
+        eindex = self.entities_index[entity.uuid]
+        pindex = self.periods_index[period.id]
+        return arrival_data_for(
+            int(self.nb_expected[self.routine, eindex].sum()),
+            int(self.nb_arrived[self.routine, eindex, pindex].sum()),
+            int(self.nb_prompt[self.routine, eindex, pindex].sum()))
+
+
+def entities_lineages():
+    """ (etype, level, ancestors including self) for all entities """
+    tree = EntityTree.get()
+    return {uuid: (entity.etype, entity.level, tree.ancestors[uuid] + [uuid])
+            for uuid, entity in tree.entities.items()}
+
+
+def completeness_matrix_for(entities, periods, indicators=None):
+    if indicators is None:
+        indicators = Indicator.get_all_routine()
+    return CompletenessMatrix(indicators=indicators,
+                              entities=entities,
+                              periods=periods)
+
+
+def agg_arrival_for_period(indicator, entity, period, matrix=None):
+    if matrix is None:
+        matrix = completeness_matrix_for(entities=[entity],
+                                         periods=[period],
+                                         indicators=[indicator])
+    return matrix.agg_arrival_for(indicator, entity, period)
 
 
 def agg_arrival_for_periods(indicator, entity, periods):
@@ -49,26 +197,22 @@ def agg_arrival_for(indicator, entity, year, month):
 
     expected_entities = expected_entities_for(indicator, entity)
 
-    qs = DataRecord.objects.filter(indicator=indicator,
-                                   period__in=periods) \
+    qs = DataRecord.objects.filter(indicator=indicator) \
+                           .for_periods(periods) \
                            .filter(entity__in=expected_entities)
 
-    nb_expected_reports = len(expected_entities)
-    nb_arrived_reports = qs.count()
-    nb_prompt_reports = qs.filter(arrival_status=DataRecord.ARRIVED_ON_TIME) \
-                          .count()
+    return arrival_data_for(
+        nb_expected_reports=len(expected_entities),
+        nb_arrived_reports=qs.count(),
+        nb_prompt_reports=qs.filter(
+            arrival_status=DataRecord.ARRIVED_ON_TIME).count())
 
-    return {
-        'nb_expected_reports': nb_expected_reports,
-        'nb_arrived_reports': nb_arrived_reports,
-        'nb_prompt_reports': nb_prompt_reports,
-        'completeness': nb_arrived_reports / nb_expected_reports,
-        'promptness': nb_prompt_reports / nb_expected_reports
-    }
 
-
-def avg_arrival_for_period(entity, period):
-    return avg_arrival_for(entity, period.year, period.month)
+def avg_arrival_for_period(entity, period, matrix=None):
+    if matrix is None:
+        matrix = completeness_matrix_for(entities=[entity],
+                                         periods=[period])
+    return matrix.avg_arrival_for(entity, period)
 
 
 def avg_arrival_for(entity, year, month):
@@ -90,9 +234,13 @@ def avg_arrival_for(entity, year, month):
     return data
 
 
-def completeness_point_for(entity, period):
-    data = avg_arrival_for_period(entity, period)
+def completeness_point_for(entity, period, matrix=None):
+    return completeness_point_from(
+        entity, period, avg_arrival_for_period(entity, period, matrix=matrix))
+
 
+def completeness_point_from(entity, period, data):
+    """ graph point of entity's arrival data for period """
     value = data['completeness'] * 100
 
     return {
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+logger = logging.getLogger(__name__)
+MISSING = object()
+
+
+class ComputationResultCache(BaseCache):
+    """ cache backend storing values as ComputationResult rows
+
+        LOCATION is unused. Entries never expire and are never culled:
+        use on caches without TIMEOUT. """
+
+    def __init__(self, location, params):
+        super(ComputationResultCache, self).__init__(params)
+
+    @property
+    def model(self):
+        from dmd.models.Computations import ComputationResult
+        return ComputationResult
+
+    def _make_keys(self, keys, version):
+        cache_keys = OrderedDict()
+        for key in keys:
+            cache_key = self.make_key(key, version=version)
+            self.validate_key(cache_key)
+            cache_keys[cache_key] = key
+        return cache_keys
+
+    def get(self, key, default=None, version=None):
+        cache_key = self.make_key(key, version=version)
+        self.validate_key(cache_key)
+        return self.model.get_many([cache_key]).get(cache_key, default)
+
+    def get_many(self, keys, version=None):
+        cache_keys = self._make_keys(keys, version)
+        return {cache_keys[cache_key]: value for cache_key, value
+                in self.model.get_many(cache_keys.keys()).items()}
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        cache_key = self.make_key(key, version=version)
+        self.validate_key(cache_key)
+        return self.model.add(cache_key, value)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        cache_key = self.make_key(key, version=version)
+        self.validate_key(cache_key)
+        return bool(self.model.set_many({cache_key: value}))
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        """ returns the keys which were replaced (had a value) """
+        cache_keys = self._make_keys(data.keys(), version)
+        replaced = self.model.set_many({cache_key: data[key] for cache_key, key
+                                        in cache_keys.items()})
+        return [cache_keys[cache_key] for cache_key in replaced]
+
+    def delete(self, key, version=None):
+        cache_key = self.make_key(key, version=version)
+        self.validate_key(cache_key)
+        self.model.delete_many([cache_key])
+
+    def delete_many(self, keys, version=None):
+        self.model.delete_many(self._make_keys(keys, version).keys())
+
+    def clear(self):
+        self.model.objects.all().delete()
+
+
+class LayeredCacheMixin(object):
+    """ a bounded in-process LRU in front of a shared cache backend
+
+        The shared backend (used by all workers) holds a version stamp,
+        changed on every overwrite or delete. Workers read it at most
+        every VERSION_CHECK_INTERVAL seconds and drop all their local
+        entries when it moved, so there is no per-key check.
+        Writing keys which had no value doesn't change it: the shared
+        backend's set() must return whether the key had a value and
+        set_many() the keys which had one.
+        Local entries never expire: only use on caches without TIMEOUT.
+        Values are shared within the process: never modify them.
+
+        OPTIONS: LOCAL_MAX_ENTRIES, VERSION_CHECK_INTERVAL (seconds) """
+
+    VERSION_KEY = 'layered-cache:version'
+
+    def __init__(self, location, params):
+        super(LayeredCacheMixin, self).__init__(location, params)
+        options = params.get('OPTIONS', {})
+        self._local_max_entries = int(
+            options.get('LOCAL_MAX_ENTRIES', 10000))
+        self._version_check_interval = float(
+            options.get('VERSION_CHECK_INTERVAL', 1))
+        self._local = OrderedDict()
+        self._local_version = None
+        self._checked_on = None
+        self._lock = threading.RLock()
+
+    def _check_version(self):
+        """ drop local entries if the shared version stamp moved """
+        now = time.time()
+        if self._checked_on is not None and \
+                now - self._checked_on < self._version_check_interval:
+            return
+        stamp = super(LayeredCacheMixin, self).get(self.VERSION_KEY)
+        with self._lock:
+            if stamp != self._local_version:
+                self._local.clear()
+                self._local_version = stamp
+            self._checked_on = now
+
+    def _bump_version(self):
+        """ have all workers, this one included, drop their local entries
+
+            the local entries may predate another worker's bump """
+        stamp = uuid.uuid4().hex
+        super(LayeredCacheMixin, self).set(self.VERSION_KEY, stamp, None)
+        with self._lock:
+            self._local.clear()
+            self._local_version = stamp
+            self._checked_on = time.time()
+
+    def _store_local(self, cache_key, value):
+        with self._lock:
+            self._local.pop(cache_key, None)
+            self._local[cache_key] = value
+            while len(self._local) > self._local_max_entries:
+                self._local.popitem(last=False)
+
+    def _get_local(self, cache_key):
+        with self._lock:
+            value = self._local.pop(cache_key, MISSING)
+            if value is not MISSING:
+                self._local[cache_key] = value
+            return value
+
+    def get(self, key, default=None, version=None):
+        self._check_version()
+        cache_key = self.make_key(key, version=version)
+        value = self._get_local(cache_key)
+        if value is MISSING:
+            value = super(LayeredCacheMixin, self).get(
+                key, MISSING, version=version)
+            if value is MISSING:
+                return default
+            self._store_local(cache_key, value)
+        return value
+
+    def get_many(self, keys, version=None):
+        self._check_version()
+        data = {}
+        shared_keys = []
+        for key in keys:
+            value = self._get_local(self.make_key(key, version=version))
+            if value is MISSING:
+                shared_keys.append(key)
+            else:
+                data[key] = value
+
+        shared_data = super(LayeredCacheMixin, self).get_many(
+            shared_keys, version=version)
+        for key, value in shared_data.items():
+            self._store_local(self.make_key(key, version=version), value)
+        data.update(shared_data)
+        return data
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        # a new key can't be outdated in other workers
+        added = super(LayeredCacheMixin, self).add(
+            key, value, timeout, version=version)
+        if added:
+            self._store_local(self.make_key(key, version=version), value)
+        return added
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        replaced = super(LayeredCacheMixin, self).set(key, value, timeout,
+                                                      version=version)
+        if replaced:
+            self._bump_version()
+        self._store_local(self.make_key(key, version=version), value)
+        return replaced
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        replaced = super(LayeredCacheMixin, self).set_many(data, timeout,
+                                                           version=version)
+        if replaced:
+            self._bump_version()
+        for key, value in data.items():
+            self._store_local(self.make_key(key, version=version), value)
+        return replaced
+
+    def delete(self, key, version=None):
+        super(LayeredCacheMixin, self).delete(key, version=version)
+        self._bump_version()
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        if not keys:
+            return
+        super(LayeredCacheMixin, self).delete_many(keys, version=version)
+        self._bump_version()
+
+    def clear(self):
+        super(LayeredCacheMixin, self).clear()
+        self._bump_version()
+
+
+class LayeredComputationResultCache(LayeredCacheMixin,
+                                    ComputationResultCache):
+    pass
@@ -5,26 +5,86 @@
 from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
 
 from django.core.cache import caches
+from django.core.signals import request_started
+from django.dispatch import receiver
 
 from dmd.arrivals import (avg_arrival_for_period, agg_arrival_for_period,
-                          completeness_point_for)
+                          arrival_data_for, completeness_point_from,
+                          completeness_matrix_for)
+from dmd.models.Computations import ComputationLock
+from dmd.models.Entities import EntityTree
+from dmd.models.Indicators import Indicator
+from dmd.models.Periods import PeriodCalendar
+from dmd.signals import records_changed
 
+# keys per get_many (keeps queries under the DB's parameters limit)
+GET_MANY_BATCH_SIZE = 500
+# seconds to wait for entries another worker is computing
+LOCK_WAIT = 5
+LOCK_POLL_INTERVAL = 0.1
 logger = logging.getLogger(__name__)
 cache = caches['computations']
+# entries already read or computed during the current request
+local = threading.local()
 
 
-def compute_completeness_for(dps, period, indicator=None):
+# cached entries are compact tuples of primitives, turned back
+# into the dicts views expect when read (see rehydrate)
+
+def arrival_counts_of(data):
+    """ (nb_expected, nb_arrived, nb_prompt) of arrival data """
+    return (data['nb_expected_reports'],
+            data['nb_arrived_reports'],
+            data['nb_prompt_reports'])
+
+
+def compute_completeness_for(dps, period, indicator=None, matrix=None):
     if indicator:
-        return agg_arrival_for_period(indicator, dps, period)
+        data = agg_arrival_for_period(indicator, dps, period, matrix=matrix)
     else:
-        return avg_arrival_for_period(dps, period)
+        data = avg_arrival_for_period(dps, period, matrix=matrix)
+    return arrival_counts_of(data)
+
+
+def compute_arrivals_for(indicator, entity, period, matrix=None):
+    return arrival_counts_of(
+        agg_arrival_for_period(indicator, entity, period, matrix=matrix))
+
+
+def compute_point_for(entity, period, matrix=None):
+    """ (entity uuid, period ordinal) + arrival counts """
+    return (entity.uuid.hex, period.ordinal) + arrival_counts_of(
+        avg_arrival_for_period(entity, period, matrix=matrix))
+
+
+def arrival_data_from(payload):
+    return arrival_data_for(*payload)
+
+
+def completeness_point_from_payload(payload):
+    entity_uuid, ordinal = payload[:2]
+    return completeness_point_from(
+        EntityTree.get().get_entity(uuid.UUID(hex=entity_uuid)),
+        PeriodCalendar.get(ordinal),
+        arrival_data_from(payload[2:]))
+
 
+REHYDRATERS = {
+    'completeness': arrival_data_from,
+    'section2-arrivals': arrival_data_from,
+    'section2-points': completeness_point_from_payload,
+}
 
-def cache_exists_for(key, **kwargs):
-    cache_key, _ = get_cache_details_for(key, **kwargs)
-    return cache.get(cache_key, None) is not None
+
+def rehydrate(key, payload):
+    """ the value views expect for a cached payload of key """
+    return REHYDRATERS[key](payload)
 
 
 def get_cache_details_for(key, **kwargs):
@@ -45,29 +105,208 @@ def get_cache_details_for(key, **kwargs):
                     if kwargs.get('entity') else '-',
                     period=kwargs.get('period').strid,
                     indicator=kwargs.get('indicator').slug)
-        computer = agg_arrival_for_period
+        computer = compute_arrivals_for
 
     elif key == 'section2-points':
         cache_key = 'json:section2-points/{entity}/{period}' \
             .format(entity=kwargs.get('entity').uuid
                     if kwargs.get('entity') else '-',
                     period=kwargs.get('period').strid)
-        computer = completeness_point_for
+        computer = compute_point_for
 
     return cache_key, computer
 
 
-def get_cached_data(key, no_retry=False, **params):
-    cache_key, computer = get_cache_details_for(key, **params)
-    # cache.get_or_set(cache_key, computer(**params))  # dj1.9
-    d = cache.get(cache_key, None)
-    if d is None:
-        update_cached_data(key, **params)
-        if not no_retry:
-            return get_cached_data(key, no_retry=True, **params)
-    return d
+def request_memo():
+    if not hasattr(local, 'memo'):
+        local.memo = {}
+    return local.memo
+
+
+def matrix_for(params_list):
+    """ a CompletenessMatrix covering all params_list entries at once """
+    entities = OrderedDict()
+    periods = OrderedDict()
+    indicators = OrderedDict([(indicator.slug, indicator) for indicator
+                              in Indicator.get_all_routine()])
+    for params in params_list:
+        entity = params.get('dps') or params.get('entity')
+        entities[entity.uuid] = entity
+        periods[params['period'].id] = params['period']
+        if params.get('indicator'):
+            indicators[params['indicator'].slug] = params['indicator']
+    return completeness_matrix_for(entities=entities.values(),
+                                   periods=periods.values(),
+                                   indicators=indicators.values())
+
+
+def get_many_from_cache(cache_keys):
+    """ cache.get_many for any number of keys """
+    cache_keys = list(OrderedDict.fromkeys(cache_keys))
+    data = {}
+    for index in range(0, len(cache_keys), GET_MANY_BATCH_SIZE):
+        data.update(cache.get_many(
+            cache_keys[index:index + GET_MANY_BATCH_SIZE]))
+    return data
+
+
+def get_many_cached_data(key, params_list, matrix=None):
+    """ get_cached_data for each params of params_list, in order
+
+        entries are read with a single get_many and the missing ones
+        computed together (off a shared matrix) then stored at once. """
+    memo = request_memo()
+    params_list = list(params_list)
+    cache_keys = [get_cache_details_for(key, **params)[0]
+                  for params in params_list]
+
+    memo.update(get_many_from_cache(
+        [cache_key for cache_key in cache_keys if cache_key not in memo]))
+
+    missing = OrderedDict()
+    for cache_key, params in zip(cache_keys, params_list):
+        if memo.get(cache_key) is None:
+            missing[cache_key] = params
+
+    if missing:
+        memo.update(compute_many(key, missing, matrix=matrix))
+
+    return [rehydrate(key, memo[cache_key]) for cache_key in cache_keys]
+
+
+def compute_and_store(key, targets, matrix=None):
+    """ compute entries of targets ({cache_key: params}) and cache them """
+    started_on = time.time()
+    if matrix is None:
+        matrix = matrix_for(targets.values())
+    computer = get_cache_details_for(key, **next(iter(targets.values())))[1]
+    computed = {cache_key: computer(matrix=matrix, **params)
+                for cache_key, params in targets.items()}
+    cache.set_many(computed, None)
+    logger.debug("Computed {nb} {key} entries in {d:.3f}s"
+                 .format(nb=len(computed), key=key,
+                         d=time.time() - started_on))
+    return computed
+
+
+def compute_many(key, targets, matrix=None):
+    """ compute_and_store targets not being computed by another worker
+
+        entries locked by another worker are waited for (LOCK_WAIT
+        seconds at most) then computed here if still missing. """
+    owner = uuid.uuid4().hex
+    locked = ComputationLock.acquire_many(targets.keys(), owner)
+    data = {}
+    if locked:
+        try:
+            data.update(compute_and_store(
+                key, OrderedDict([(cache_key, params) for cache_key, params
+                                  in targets.items() if cache_key in locked]),
+                matrix=matrix))
+        finally:
+            ComputationLock.release_many(locked, owner)
+
+    pending = [cache_key for cache_key in targets.keys()
+               if cache_key not in locked]
+    if not pending:
+        return data
+
+    started_on = time.time()
+    nb_pending = len(pending)
+    while pending and time.time() - started_on < LOCK_WAIT:
+        time.sleep(LOCK_POLL_INTERVAL)
+        data.update(get_many_from_cache(pending))
+        pending = [cache_key for cache_key in pending
+                   if cache_key not in data]
+    logger.info("Waited {d:.3f}s for {nb} {key} entries computed elsewhere"
+                " ({nb_missing} still missing)"
+                .format(d=time.time() - started_on, nb=nb_pending, key=key,
+                        nb_missing=len(pending)))
+
+    if pending:
+        data.update(compute_and_store(
+            key, OrderedDict([(cache_key, targets[cache_key])
+                              for cache_key in pending]), matrix=matrix))
+    return data
+
+
+def get_cached_data(key, **params):
+    return get_many_cached_data(key, [params])[0]
+
+
+def update_many_cached_data(key, params_list, matrix=None, check=False):
+    """ compute missing entries of params_list (all of them if checking)
+
+        changed entries are stored at once.
+        returns the params of entries which were cached but stale """
+    params_list = list(params_list)
+    cache_keys = [get_cache_details_for(key, **params)[0]
+                  for params in params_list]
+    cached = get_many_from_cache(cache_keys)
+
+    targets = OrderedDict([(cache_key, params) for cache_key, params
+                           in zip(cache_keys, params_list)
+                           if check or cache_key not in cached])
+    if not targets:
+        return []
+
+    if matrix is None:
+        matrix = matrix_for(targets.values())
+    computer = get_cache_details_for(key, **params_list[0])[1]
+    computed = {cache_key: computer(matrix=matrix, **params)
+                for cache_key, params in targets.items()}
+    changed = {cache_key: data for cache_key, data in computed.items()
+               if cached.get(cache_key) != data}
+    if changed:
+        cache.set_many(changed, None)
+        memo = request_memo()
+        for cache_key in changed.keys():
+            memo.pop(cache_key, None)
+
+    return [targets[cache_key] for cache_key in changed.keys()
+            if cache_key in cached]
+
+
+def cache_keys_for_record(record):
+    """ all cache keys depending on a DataRecord """
+    keys = []
+    indicator = record.indicator
+    period = record.period
+    for entity in EntityTree.get().ancestors_of(record.entity_id,
+                                                include_self=True):
+        for ind in (indicator, None):
+            keys.append(get_cache_details_for(
+                'completeness', dps=entity, period=period, indicator=ind)[0])
+        keys.append(get_cache_details_for(
+            'section2-arrivals', entity=entity, period=period,
+            indicator=indicator)[0])
+        keys.append(get_cache_details_for(
+            'section2-points', entity=entity, period=period)[0])
+    return keys
+
+
+def invalidate_cached_data_for(records):
+    keys = set()
+    seen = set()
+    for record in records:
+        ident = (record.indicator_id, record.period_id, record.entity_id)
+        if ident in seen:
+            continue
+        seen.add(ident)
+        keys.update(cache_keys_for_record(record))
+    if keys:
+        logger.debug("Invalidating {} cache entries".format(len(keys)))
+        cache.delete_many(list(keys))
+        memo = request_memo()
+        for cache_key in keys:
+            memo.pop(cache_key, None)
+
+
+@receiver(records_changed)
+def records_changed_handler(sender, records, **kwargs):
+    invalidate_cached_data_for(records)
 
 
-def update_cached_data(key, **params):
-    cache_key, computer = get_cache_details_for(key, **params)
-    cache.set(cache_key, computer(**params), None)
+@receiver(request_started)
+def request_started_handler(sender, **kwargs):
+    local.memo = {}
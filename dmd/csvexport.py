@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import logging
+import os
+import StringIO
+
+import unicodecsv as csv
+
+from dmd.models.DataRecords import DataRecord
+from dmd.models.Entities import Entity, EntityTree
+from dmd.models.Indicators import Indicator
+
+HEADERS = ["PERIOD", "INDICATOR", "DPS", "ZS",
+           "NUMERATOR", "DENOMINATOR", "VALUE",
+           "DISPLAY-VALUE"]
+# bytes of CSV to accumulate before handing them out
+CHUNK_SIZE = 256 * 1024
+logger = logging.getLogger(__name__)
+
+
+def get_records():
+    return DataRecord.objects.valid().order_by(
+        'period__year',
+        'period__month',
+        'entity__level',
+        'entity__name',
+        'indicator__number')
+
+
+def iter_flat_records(records_qs):
+    """ (year, month, indicator, dps, zs, numerator, denominator, value,
+        human) for a DataRecord QuerySet, without loading instances
+
+        indicators are fetched once and DPS/ZS come from the EntityTree """
+    empty = ""
+    tree = EntityTree.get()
+    # ordering columns would be part of the DISTINCT
+    indicators = Indicator.objects.in_bulk(
+        records_qs.order_by().values_list('indicator', flat=True).distinct())
+    short_names = {}
+
+    def short_name_of(entity_uuid, etype):
+        key = (entity_uuid, etype)
+        if key not in short_names:
+            ancestor = tree.ancestor_of(entity_uuid, etype)
+            short_names[key] = getattr(ancestor, 'short_name', empty)
+        return short_names[key]
+
+    for year, month, slug, entity_uuid, numerator, denominator \
+            in records_qs.values_list('period__year', 'period__month',
+                                      'indicator', 'entity',
+                                      'numerator', 'denominator') \
+                         .iterator():
+        indicator = indicators[slug]
+        value = indicator.compute_value(numerator, denominator)
+        yield (year, month, indicator,
+               short_name_of(entity_uuid, Entity.PROVINCE),
+               short_name_of(entity_uuid, Entity.ZONE),
+               numerator, denominator, value,
+               indicator.format_value(value=value,
+                                      numerator=numerator,
+                                      denominator=denominator))
+
+
+def iter_rows(records_qs):
+    """ CSV rows for a DataRecord QuerySet """
+    for year, month, indicator, dps, zs, numerator, denominator, value, \
+            human in iter_flat_records(records_qs):
+        yield ["{y}-{m}".format(y=year, m=month), indicator.number,
+               dps, zs, numerator, denominator, value, human]
+
+
+def iter_csv(records_qs, chunk_size=CHUNK_SIZE):
+    """ CSV export of a DataRecord QuerySet as chunks of bytes """
+    buff = StringIO.StringIO()
+    csv_writer = csv.writer(buff)
+    csv_writer.writerow(HEADERS)
+
+    for row in iter_rows(records_qs):
+        csv_writer.writerow(row)
+        if buff.tell() >= chunk_size:
+            yield buff.getvalue()
+            buff.seek(0)
+            buff.truncate()
+
+    yield buff.getvalue()
+
+
+def export_to_csv(records_qs, save_to):
+    """ write the CSV export to a file, replacing it once complete """
+    tmp_path = "{}.tmp".format(save_to)
+    with open(tmp_path, 'wb') as stream:
+        for chunk in iter_csv(records_qs):
+            stream.write(chunk)
+    os.rename(tmp_path, save_to)
@@ -5,19 +5,47 @@
 from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 import logging
+import threading
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from requests.packages.urllib3.util.retry import Retry
 from django.conf import settings
 
 AUTH = HTTPBasicAuth(settings.DHIS_USER, settings.DHIS_PASSWORD)
 logger = logging.getLogger(__name__)
 url_from_path = lambda path: "{}{}".format(settings.DHIS_BASE_URL, path)
 
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """ process-wide HTTP session to DHIS
+
+        keeps connections alive across requests (up to DHIS_MAX_WORKERS
+        of them) and retries failed ones with an exponential backoff """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=settings.DHIS_MAX_RETRIES,
+                          backoff_factor=settings.DHIS_RETRY_BACKOFF,
+                          status_forcelist=[500, 502, 503, 504])
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=settings.DHIS_MAX_WORKERS,
+                                  max_retries=retry)
+            _session = requests.Session()
+            _session.auth = AUTH
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
 
 def get_dhis(path, params={}, as_json=True):
     url = url_from_path(path)
-    req = requests.get(url, auth=AUTH, params=params)
+    req = get_session().get(url, params=params,
+                            timeout=settings.DHIS_TIMEOUT)
 
     try:
         req.raise_for_status()
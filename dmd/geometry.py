@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import logging
+import json
+from collections import OrderedDict
+from math import sqrt, log10, ceil
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+# no model import in this module: migrations use it
+
+# simplification tolerance (in degrees) of each level of detail
+# (keys are Entity.DETAIL_LOW and Entity.DETAIL_MEDIUM)
+SIMPLIFY_TOLERANCES = OrderedDict([
+    ('low', 0.01),  # ~1km
+    ('medium', 0.001),  # ~100m
+])
+
+
+def douglas_peucker(points, tolerance):
+    """ points of a line kept by the Douglas-Peucker algorithm
+
+        `points` is an (x, y) array. The first and last ones are kept
+        and so is, recursively, the farthest one from the segment between
+        them if it's further than `tolerance`. """
+    keep = numpy.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start = points[first]
+        dx, dy = points[last] - start
+        inner = points[first + 1:last] - start
+        length = sqrt(dx * dx + dy * dy)
+        if length:
+            distances = numpy.abs(dx * inner[:, 1] - dy * inner[:, 0]) \
+                / length
+        else:
+            # closed ring: distance to its first point
+            distances = numpy.hypot(inner[:, 0], inner[:, 1])
+        farthest = numpy.argmax(distances)
+        if distances[farthest] > tolerance:
+            farthest += first + 1
+            keep[farthest] = True
+            stack.extend([(first, farthest), (farthest, last)])
+    return points[keep]
+
+
+def simplify_geometry(geometry, tolerance):
+    """ copy of a (Multi)Polygon GeoJSON geometry with simplified rings
+
+        coordinates are rounded to a tenth of `tolerance`.
+        rings too small to remain valid polygons are left untouched. """
+    decimals = int(ceil(-log10(tolerance))) + 1
+
+    def simplify_ring(ring):
+        simplified = douglas_peucker(numpy.array(ring, dtype=float),
+                                     tolerance)
+        if len(simplified) < 4:
+            return ring
+        return numpy.round(simplified, decimals).tolist()
+
+    if geometry['type'] == 'Polygon':
+        coordinates = [simplify_ring(ring)
+                       for ring in geometry['coordinates']]
+    elif geometry['type'] == 'MultiPolygon':
+        coordinates = [[simplify_ring(ring) for ring in polygon]
+                       for polygon in geometry['coordinates']]
+    else:
+        coordinates = geometry['coordinates']
+    return {'type': geometry['type'], 'coordinates': coordinates}
+
+
+def simplified_geometries(geometry):
+    """ simplified geometry text for each level of detail
+
+        `geometry` is the text of a GeoJSON geometry, as on Entity """
+    if not geometry:
+        return {detail: None for detail in SIMPLIFY_TOLERANCES.keys()}
+    geometry = json.loads(geometry)
+    return {detail: json.dumps(simplify_geometry(geometry, tolerance))
+            for detail, tolerance in SIMPLIFY_TOLERANCES.items()}
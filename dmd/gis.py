@@ -5,17 +5,25 @@
 from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 import logging
+import hashlib
+import json
 import os
 import string
 import copy
+import threading
+from collections import OrderedDict
 from math import radians, cos, sqrt
 
 from PIL import Image, ImageDraw, ImageFont
-import pandas as pd
+import numpy
 from babel.numbers import format_decimal
+from django.conf import settings
+from django.db.models import Max, Count
 import textwrap
 
 from dmd.models.DataRecords import DataRecord
+from dmd.models.Entities import Entity, EntityTree
+from dmd.models.Aggregates import DataAggregate
 
 logger = logging.getLogger(__name__)
 
@@ -36,6 +44,8 @@ SCALE_PADDING = CANVAS_SIZE // 100
 LEGEND_PADDING = CANVAS_SIZE // 100
 TITLE_PADDING = CANVAS_SIZE // 100
 INDEX_PADDING = CANVAS_SIZE // 100
+# loaded fonts, by (variant, size, mono)
+FONTS = {}
 
 
 # def distance(pointa, pointb):
@@ -105,10 +115,95 @@ def get_bounds(coordinates):
     return min(x), min(y), max(x), max(y)
 
 
-def children_bounds(entity):
-    return get_bounds([f.get('geometry', {}).get('coordinates', [])
-                       for f in entity.children_geojson.get('features', {})
-                       if f.get('geometry', {})])
+class EntityGeometry(object):
+    """ parsed geometry of an entity
+
+        `outline` is the (x, y) array of its polygons' outer rings,
+        one after the other, as drawn on maps. """
+
+    def __init__(self, geometry):
+        if geometry['type'] == 'MultiPolygon':
+            coordinates = geometry['coordinates']
+        else:
+            coordinates = [geometry['coordinates']]
+
+        self.outline = numpy.array([point
+                                    for polygon in coordinates
+                                    for point in polygon[0]], dtype=float)
+        self.bounds = get_bounds(geometry['coordinates'])
+
+
+class GeometryCache(object):
+    """ process-wide cache of parsed geometries and projected pixels
+
+        Geometries are parsed once and their children's pixels computed
+        once per parent and canvas size.
+        Everything is dropped when the EntityTree version changes,
+        as it does when entities are saved by import_geojson.
+        Reentrant lock: projection_for uses geometries_for. """
+
+    _lock = threading.RLock()
+    _version = None
+    _geometries = {}
+    _projections = {}
+
+    @classmethod
+    def refresh(cls):
+        with cls._lock:
+            version = EntityTree.get().version
+            if version != cls._version:
+                cls._version = version
+                cls._geometries = {}
+                cls._projections = {}
+
+    @classmethod
+    def geometries_for(cls, uuids):
+        """ EntityGeometry (None if missing) of each entity uuid """
+        with cls._lock:
+            cls.refresh()
+            missing = [uuid for uuid in uuids if uuid not in cls._geometries]
+            if missing:
+                for uuid, geometry in Entity.objects.filter(uuid__in=missing) \
+                        .values_list('uuid', 'geometry'):
+                    geometry = json.loads(geometry) if geometry else None
+                    cls._geometries[uuid] = EntityGeometry(geometry) \
+                        if geometry else None
+            return {uuid: cls._geometries.get(uuid) for uuid in uuids}
+
+    @classmethod
+    def projection_for(cls, entity, width, height):
+        """ (bbox, pixels by uuid) of entity's children on a canvas """
+        with cls._lock:
+            cls.refresh()
+            key = (entity.uuid, width, height)
+            if key not in cls._projections:
+                geometries = [geometry for geometry in cls.geometries_for(
+                    [child.uuid for child
+                     in EntityTree.get().children_of(entity.uuid)]).items()
+                    if geometry[1] is not None]
+                if geometries:
+                    bounds = numpy.array([geometry.bounds
+                                          for _, geometry in geometries])
+                else:
+                    # no child to draw: frame the entity itself
+                    own = cls.geometries_for([entity.uuid])[entity.uuid]
+                    if own is None:
+                        raise ValueError("No geometry for {} nor its children"
+                                         .format(entity))
+                    bounds = numpy.array([own.bounds])
+                bbox = (bounds[:, 0].min(), bounds[:, 1].min(),
+                        bounds[:, 2].max(), bounds[:, 3].max())
+
+                xratio = width / (bbox[2] - bbox[0])
+                yratio = height / (bbox[3] - bbox[1])
+                pixels = {}
+                for uuid, geometry in geometries:
+                    xs = width - ((bbox[2] - geometry.outline[:, 0]) * xratio)
+                    ys = (bbox[3] - geometry.outline[:, 1]) * yratio
+                    pixels[uuid] = zip(xs.astype(int).tolist(),
+                                       ys.astype(int).tolist())
+                cls._projections[key] = (bbox, pixels)
+            return cls._projections[key]
 
 
 def display_right(entity):
@@ -127,38 +222,79 @@ def display_right(entity):
                                  "Haut Katanga DPS")
 
 
-class QuantileScale(object):
+def jenks_breaks(values, nb_classes):
+    """ Jenks natural breaks (Fisher's exact method)
+
+        returns nb_classes + 1 boundaries, from min to max """
+    values = numpy.sort(numpy.asarray(values, dtype=float))
+    nb_values = len(values)
+
+    # lower class limits and variance combinations
+    limits = numpy.zeros((nb_values + 1, nb_classes + 1), dtype=int)
+    variances = numpy.full((nb_values + 1, nb_classes + 1), numpy.inf)
+    limits[1, 1:] = 1
+    variances[1, 1:] = 0
+
+    for upper in range(2, nb_values + 1):
+        sum_values = sum_squares = nb = 0.
+        variance = 0.
+        for lower in range(upper, 0, -1):
+            value = values[lower - 1]
+            sum_values += value
+            sum_squares += value * value
+            nb += 1
+            variance = sum_squares - sum_values * sum_values / nb
+            if lower == 1:
+                continue
+            # all class counts at once
+            candidates = variance + variances[lower - 1, 1:-1]
+            better = variances[upper, 2:] >= candidates
+            limits[upper, 2:][better] = lower
+            variances[upper, 2:][better] = candidates[better]
+        limits[upper, 1] = 1
+        variances[upper, 1] = variance
+
+    breaks = [values[0]] * nb_classes + [values[-1]]
+    upper = nb_values
+    for nb in range(nb_classes, 1, -1):
+        breaks[nb - 1] = values[limits[upper, nb] - 2]
+        upper = limits[upper, nb] - 1
+    return breaks
+
+
+class ColorScale(object):
+    """ classifies values into colors using boundaries
+
+        a value gets the color of the last boundary it reaches.
+        Subclasses compute boundaries from values, one per color,
+        starting with the minimum and ending with the maximum. """
 
     def __init__(self, values, colors):
         self.colors = copy.copy(colors)
-        self.serie = pd.Series(values)
+        self.values = numpy.asarray(values, dtype=float)
 
         # when there's no data
-        if not len(self.serie):
+        if not self.values.size:
             self._boundaries = []
             return
 
         # when there's less than 4 data
-        if len(self.serie) < len(self.colors):
-            self.colors = self.colors[:len(self.serie)]
+        if self.values.size < len(self.colors):
+            self.colors = self.colors[:self.values.size]
 
-        self._min = self.serie.min()
-        self._max = self.serie.max()
+        self._min = self.values.min()
+        self._max = self.values.max()
         self.nb_breaks = len(self.colors)
 
         # single value
         if self.nb_breaks == 1:
-            self._boundaries = [self.serie[0]]
+            self._boundaries = [self.values[0]]
             return
 
-        x = 1 / (self.nb_breaks - 1)
-        self.breaks = [x * i for i in range(1, self.nb_breaks)]
-        self.quantile = self.serie.quantile([0, .33, .66, 1])
+        self._boundaries = self.compute_boundaries()
 
-        try:
-            self._boundaries = self.quantile.tolist()
-        except:
-            self._boundaries = []
+    def compute_boundaries(self):
+        raise NotImplementedError()
 
     @property
     def min(self):
@@ -182,20 +318,47 @@ class QuantileScale(object):
                 return self.max
             return None
 
-    def color_for_value(self, value):
-        if value < self.boundaries[0]:
-            return self.colors[0]
+    def classify(self, values):
+        """ color index of each value """
+        return numpy.clip(
+            numpy.searchsorted(self.boundaries, values, side='right') - 1,
+            0, len(self.colors) - 1)
 
-        for index, bound in enumerate(self.boundaries):
-            if value < bound:
-                return self.colors[index - 1]
+    def colors_for_values(self, values):
+        return [self.colors[index] for index in self.classify(values)]
 
-        return self.colors[-1]
+    def color_for_value(self, value):
+        return self.colors_for_values([value])[0]
 
     def available_colors(self):
         return self.colors
 
 
+class QuantileScale(ColorScale):
+
+    def compute_boundaries(self):
+        return numpy.percentile(self.values, [0, 33, 66, 100]).tolist()
+
+
+class EqualIntervalScale(ColorScale):
+
+    def compute_boundaries(self):
+        return numpy.linspace(self.min, self.max, self.nb_breaks).tolist()
+
+
+class JenksScale(ColorScale):
+
+    def compute_boundaries(self):
+        return jenks_breaks(self.values, self.nb_breaks - 1)
+
+
+SCALES = {
+    'quantile': QuantileScale,
+    'equal': EqualIntervalScale,
+    'jenks': JenksScale,
+}
+
+
 def letter_for(index):
     if index > 25:
         return string.ascii_uppercase[0] + string.ascii_uppercase[index - 25]
@@ -209,11 +372,50 @@ def get_image(width, height, alpha=0):
 
 
 def get_font(variant, size, mono=False):
-    return ImageFont.truetype(
-        os.path.join(FONTS_DIR,
-                     "Roboto{mono}-{variant}.ttf"
-                     .format(variant=variant.title(),
-                             mono="Mono" if mono else '')), size)
+    """ TrueType font, loaded from disk once per process """
+    key = (variant, size, mono)
+    if key not in FONTS:
+        FONTS[key] = ImageFont.truetype(
+            os.path.join(FONTS_DIR,
+                         "Roboto{mono}-{variant}.ttf"
+                         .format(variant=variant.title(),
+                                 mono="Mono" if mono else '')), size)
+    return FONTS[key]
+
+
+class LayerCache(object):
+    """ process-wide cache of rendered map layers (title, scale, ...)
+
+        Layers are keyed by everything they are drawn from (texts,
+        sizes, colors) so an entry never gets outdated.
+        Least recently used ones are dropped past MAX_SIZE bytes.
+        Cached images are shared: only paste them, never draw on them.
+        Layers are built under the lock, so each of them once. """
+
+    MAX_SIZE = 64 * 1024 * 1024
+
+    _lock = threading.RLock()
+    _layers = OrderedDict()
+    _size = 0
+
+    @classmethod
+    def get_or_build(cls, key, build):
+        """ cached layer for key, calling build() to render it if needed """
+        with cls._lock:
+            if key in cls._layers:
+                layer = cls._layers.pop(key)
+            else:
+                layer = build()
+                cls._size += cls.size_of(layer)
+                while cls._layers and cls._size > cls.MAX_SIZE:
+                    cls._size -= cls.size_of(
+                        cls._layers.popitem(last=False)[1])
+            cls._layers[key] = layer
+            return layer
+
+    @classmethod
+    def size_of(cls, layer):
+        return layer.size[0] * layer.size[1] * len(layer.getbands())
 
 
 def build_title_for(indicator, periods, entity):
@@ -227,6 +429,11 @@ def build_title_for(indicator, periods, entity):
         periodb=periods[-1].name,
         period=periods[-1].name,
         entity=entity.short_name)
+    return LayerCache.get_or_build(('title', title),
+                                   lambda: draw_title(title))
+
+
+def draw_title(title):
     font = get_font('Medium', CANVAS_SIZE // 30)
     options = {
         'font': font,
@@ -258,7 +465,6 @@ def build_title_for(indicator, periods, entity):
     tw, th = image_draw.textsize(title, font=font)
     height = ypos + th
     return image.crop((0, 0, image.size[0], height))
-    return image
 
 
 def build_scale_for(bbox):
@@ -270,7 +476,12 @@ def build_scale_for(bbox):
         * bbox_distance / CANVAS_SIZE
     scale_distance = roundup(approx_scale_distance)
     scale_size = int(scale_distance * CANVAS_SIZE // bbox_distance)
+    return LayerCache.get_or_build(
+        ('scale', scale_distance, scale_size),
+        lambda: draw_scale(scale_distance, scale_size))
+
 
+def draw_scale(scale_distance, scale_size):
     # setup image
     scale_width = scale_size + 2
     scale_height = SCALE_PADDING * 2
@@ -304,25 +515,9 @@ def build_scale_for(bbox):
 
 
 def build_legend_for(scale):
-    font = get_font('Thin', CANVAS_SIZE // 75)
-
-    # color square dimensions
-    ltw = 30
-    lth = 30
-
-    # legend spacers
-    spacer = LEGEND_PADDING
-    tspacer = spacer // 2
-
-    # sandbox to write text to for measurements only
-    sandbox = get_image(CANVAS_SIZE, CANVAS_SIZE)
-    sandbox_draw = ImageDraw.Draw(sandbox)
-    text_width = lambda text: sandbox_draw.textsize(text, font=font)[0]
-
-    # prepare labels and find out required text width
+    # prepare labels
     labels = []
     lower_bound = 0
-    ltext_width = 0
     avail_colors = []
     avail_colors = scale.available_colors() if scale.boundaries else []
     for index, color in enumerate(avail_colors):
@@ -330,14 +525,31 @@ def build_legend_for(scale):
         color_text = "{lb} – {ub}".format(
             lb=format_decimal(lower_bound, format=LEGEND_FORMAT),
             ub=format_decimal(upper_bound - .1, format=LEGEND_FORMAT))
-        ltext_width = max([ltext_width, text_width(color_text)])
         lower_bound = upper_bound
         labels.append(color_text)
     # missing data
     labels.append("manquant")
-    ltext_width = max([ltext_width, text_width("manquant")])
     avail_colors.append(COLOR_INITIAL)
 
+    return LayerCache.get_or_build(
+        ('legend', tuple(labels), tuple(avail_colors)),
+        lambda: draw_legend(labels, avail_colors))
+
+
+def draw_legend(labels, avail_colors):
+    font = get_font('Thin', CANVAS_SIZE // 75)
+
+    # color square dimensions
+    ltw = 30
+    lth = 30
+
+    # legend spacers
+    spacer = LEGEND_PADDING
+    tspacer = spacer // 2
+
+    # required text width
+    ltext_width = max([font.getsize(label)[0] for label in labels])
+
     # draw background
     legend_width = LEGEND_PADDING + ltw + tspacer \
         + ltext_width + LEGEND_PADDING
@@ -371,6 +583,10 @@ def build_legend_for(scale):
 
 def build_index_for(indicator, periods, children):
 
+    if len(periods) > 1:
+        # pre-rolled values of all children at once
+        summaries = DataAggregate.summaries_for(indicator, children, periods)
+
     def value_text_for(indicator, periods, child):
         if len(periods) == 1:
             dr = DataRecord.get_or_none(
@@ -382,26 +598,14 @@ def build_index_for(indicator, periods, children):
                 return "-"
             return dr.human()
         else:
-            dr = indicator.data_for(periods=periods, entity=child)
+            dr = indicator.aggregate_data_for(
+                child, periods, summary=summaries[child.uuid], has_data=None)
             return dr['human']
 
-    font = get_font('Regular', CANVAS_SIZE // 75, mono=True)
-
-    # legend spacers
-    spacer = INDEX_PADDING
-    hspacer = 30
-    tspacer = spacer // 2
-
-    # sandbox to write text to for measurements only
-    sandbox = get_image(CANVAS_SIZE, CANVAS_SIZE)
-    sandbox_draw = ImageDraw.Draw(sandbox)
-    text_width = lambda text: sandbox_draw.textsize(text, font=font)[0]
-
-    # prepare labels and find out required text width
+    # prepare labels
     text_fmt = "{name}{sp}{value}"
     sp = " "
     labels = []
-    itext_width = 0
     spaced_text = lambda mxl, label, name, value: text_fmt.format(
         name=name,
         sp=" ".join(['' for _ in range(mxl - len(label) + 2)]),
@@ -411,11 +615,27 @@ def build_index_for(indicator, periods, children):
         name = "{}. {}".format(letter_for(index), child.short_name)
         value = value_text_for(indicator, periods, child)
         child_text = text_fmt.format(name=name, sp=sp, value=value)
-        itext_width = max([itext_width, text_width(child_text)])
         labels.append((child_text, name, value))
-    max_chars = max([len(s[0]) for s in labels])
+    texts = [child_text for child_text, _, _ in labels]
+    max_chars = max([len(text) for text in texts])
     labels = [spaced_text(max_chars, *label) for label in labels]
 
+    return LayerCache.get_or_build(('index', tuple(texts), tuple(labels)),
+                                   lambda: draw_index(texts, labels))
+
+
+def draw_index(texts, labels):
+    """ index image of labels, as wide as the widest of texts """
+    font = get_font('Regular', CANVAS_SIZE // 75, mono=True)
+
+    # legend spacers
+    spacer = INDEX_PADDING
+    hspacer = 30
+    tspacer = spacer // 2
+
+    # required text width
+    itext_width = max([font.getsize(text)[0] for text in texts])
+
     # draw background
     index_width = INDEX_PADDING + tspacer \
         + itext_width + INDEX_PADDING
@@ -443,35 +663,105 @@ def build_index_for(indicator, periods, children):
     return image
 
 
-def fname_for(entity, periods, indicator):
-    return "{perioda}_{periodb}_{entity}_indic{indicator}.png".format(
-        entity=entity.short_name,
-        perioda=periods[0].strid,
-        periodb=periods[-1].strid,
-        indicator=indicator.number)
+def fname_for(entity, periods, indicator, version=None):
+    return "{perioda}_{periodb}_{entity}_indic{indicator}{version}.png" \
+        .format(entity=entity.short_name,
+                perioda=periods[0].strid,
+                periodb=periods[-1].strid,
+                indicator=indicator.number,
+                version="_v{}".format(version) if version else "")
+
+
+def data_version(last_change, nb_records):
+    """ short identifier of the state of a set of DataRecord """
+    return hashlib.md5("{}/{}".format(last_change, nb_records)) \
+        .hexdigest()[:10]
+
+
+def data_version_for(entity, periods, indicator):
+    """ data_version of the records a map depends on
+
+        any record creation, edition or validation (all of which set
+        `updated_on`) for the entity or its descendants changes it """
+    data = DataRecord.objects.filter(indicator=indicator,
+                                     entity__tree_id=entity.tree_id,
+                                     entity__lft__gte=entity.lft,
+                                     entity__rght__lte=entity.rght) \
+                             .for_periods(periods) \
+                             .aggregate(last_change=Max('updated_on'),
+                                        nb_records=Count('id'))
+    return data_version(**data)
+
+
+def maps_dir():
+    return os.path.join(settings.EXPORT_REPOSITORY, 'png_map')
+
+
+def touch_map(fname):
+    """ mark a cached map as just used, for sweep_maps """
+    os.utime(os.path.join(maps_dir(), fname), None)
+
+
+def discard_versions_of(fname):
+    """ remove other versions of a map, outdated by this one """
+    prefix = fname.rsplit('_v', 1)[0] + '_v'
+    for other in os.listdir(maps_dir()):
+        if other.startswith(prefix) and other.endswith('.png') \
+                and other != fname:
+            os.remove(os.path.join(maps_dir(), other))
+
+
+def sweep_maps(max_size=None):
+    """ remove least recently used maps until under max_size bytes """
+    if max_size is None:
+        max_size = settings.PNG_MAP_CACHE_MAX_SIZE
+
+    maps = []
+    for fname in os.listdir(maps_dir()):
+        # initial map is not data-dependent
+        if not fname.endswith('.png') or fname == 'initial.png':
+            continue
+        stat = os.stat(os.path.join(maps_dir(), fname))
+        maps.append((stat.st_mtime, stat.st_size, fname))
+
+    total_size = sum([size for _, size, _ in maps])
+    nb_removed = 0
+    for _, size, fname in sorted(maps):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(os.path.join(maps_dir(), fname))
+        except OSError:
+            # removed concurrently
+            pass
+        total_size -= size
+        nb_removed += 1
+    return nb_removed
 
 
 def gen_map_for(entity, periods, indicator, save_as=None,
                 with_title=True, with_legend=True,
-                with_index=True, with_scale=True):
+                with_index=True, with_scale=True,
+                scale_method='quantile'):
 
-    children = sorted(entity.get_children(), key=lambda x: x.short_name)
-    bbox = children_bounds(entity)
+    children = sorted(EntityTree.get().children_of(entity.uuid),
+                      key=lambda x: x.short_name)
+    bbox, children_pixels = GeometryCache.projection_for(
+        entity, CANVAS_SIZE, CANVAS_SIZE)
 
     # data = indicator.data_for(periods=periods, entity=entity)
     data = DataRecord.get_for(periods[-1] if periods else None,
                               entity, indicator)
     # from pprint import pprint as pp ; pp(data.values())
-    scale = QuantileScale(values=[x['value'] for x in data.values()],
-                          colors=MAP_COLORS)
+    uuids = data.keys()
+    values = [data[uuid]['value'] for uuid in uuids]
+    scale = SCALES[scale_method](values=values, colors=MAP_COLORS)
+
+    # all children colored at once
+    colors = dict(zip(uuids, scale.colors_for_values(values)))
 
     def color_for(e):
-        if data is None:
-            return COLOR_INITIAL
-        try:
-            return scale.color_for_value(data[e.uuids]['value'])
-        except KeyError:
-            return COLOR_INITIAL
+        return colors.get(e.uuids, COLOR_INITIAL)
 
     # setup coordinate system
     xdist = bbox[2] - bbox[0]
@@ -490,18 +780,9 @@ def gen_map_for(entity, periods, indicator, save_as=None,
 
     # draw each feature independently
     for index, child in enumerate(children):
-        if not child.geojson.get('geometry'):
+        if child.uuid not in children_pixels:
             continue
-        pixels = []
-
-        if child.geojson['geometry']['type'] == 'MultiPolygon':
-            coordinates = child.geojson['geometry']['coordinates']
-        else:
-            coordinates = [child.geojson['geometry']['coordinates']]
-
-        pixels = [mmap(x, y)
-                  for feature_coord in coordinates
-                  for x, y in feature_coord[0]]
+        pixels = children_pixels[child.uuid]
 
         # draw polygon
         feature_draw = ImageDraw.Draw(image)
@@ -5,72 +5,18 @@
 from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 import logging
-import StringIO
-import sys
 
 from django.core.management.base import BaseCommand
 from django.conf import settings
-import unicodecsv as csv
 
-from dmd.models import DataRecord, Metadata
+from dmd.models import Metadata
+from dmd.csvexport import get_records, export_to_csv
 from dmd.xlsx.xlexport import export_to_spreadsheet
 from dmd.utils import chdir_dmd
 
 logger = logging.getLogger(__name__)
 
 
-def get_records():
-    return DataRecord.objects.valid().order_by(
-        'period__year',
-        'period__month',
-        'entity__level',
-        'entity__name',
-        'indicator__number')
-
-
-def get_csv_for(records_qs, save_to=None):
-    headers = ["PERIOD", "INDICATOR", "DPS", "ZS",
-               "NUMERATOR", "DENOMINATOR", "VALUE",
-               "DISPLAY-VALUE"]
-    empty = ""
-
-    if save_to:
-        stream = open(save_to, 'w')
-    else:
-        stream = StringIO.StringIO()
-    csv_writer = csv.DictWriter(stream, fieldnames=headers)
-
-    csv_writer.writeheader()
-
-    row = 0
-    for record in records_qs.iterator():
-        csv_writer.writerow({
-            'PERIOD': record.period.strid,
-            'INDICATOR': record.indicator.number,
-            # 'LOCATION': record.entity.uuids,
-            'DPS': getattr(record.entity.get_dps(), 'short_name', empty),
-            'ZS': getattr(record.entity.get_zs(), 'short_name', empty),
-            # 'INDIC-SLUG': record.indicator.slug,
-            'NUMERATOR': record.numerator,
-            'DENOMINATOR': record.denominator,
-            'VALUE': record.value,
-            'DISPLAY-VALUE': record.human(),
-            # 'INDIC-NAME': record.indicator.name
-        })
-
-        sys.stdout.write("Exporting row #: {}   \r".format(row))
-        sys.stdout.flush()
-
-        row += 1
-
-    stream.close()
-
-    if save_to:
-        return
-
-    return stream
-
-
 class Command(BaseCommand):
 
     def handle(self, *args, **kwargs):
@@ -82,7 +28,7 @@ class Command(BaseCommand):
                     .format(settings.ALL_EXPORT_PATH))
         qs = get_records()
         nb_records = qs.count()
-        get_csv_for(qs, save_to=settings.ALL_EXPORT_PATH)
+        export_to_csv(qs, save_to=settings.ALL_EXPORT_PATH)
 
         logger.info("Exporting all DataRecord (XLS 1sheet/indicator) to {}"
                     .format(settings.ALL_EXPORT_XLSX_PATH))
@@ -5,9 +5,10 @@
 from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 import logging
-import copy
+from multiprocessing.pool import ThreadPool
 from pprint import pprint as pp
 
+from django.conf import settings
 from django.core.management.base import BaseCommand
 from optparse import make_option
 
@@ -21,10 +22,46 @@ from dmd.utils import data_ident_for, chdir_dmd
 
 DEBUG = True
 NB_PREVIOUS_PERIODS = 3
+# DRC, DPS, ZS, AS
+NB_LEVELS = 4
+UPATH = '/analytics.json'
 logger = logging.getLogger(__name__)
 dhisbot = Partner.get_or_none('dhisbot')
 
 
+def analytics_params(dhis_ids, periods, entities):
+    return {
+        'dimension': ['dx:{}'.format(";".join(dhis_ids)),
+                      'pe:{}'.format(
+                      ";".join([pe.dhis_strid for pe in periods])),
+                      'ou:{}'.format(
+                      ";".join([entity.dhis_id for entity in entities]))],
+        'displayProperty': 'NAME',
+        'outputIdScheme': 'ID',
+        'skipRounding': True,
+    }
+
+
+def rows_by_org_unit(jsdata):
+    """ (dx, pe, value) analytics rows grouped by org unit id """
+    headers = [header['name'] for header in jsdata.get('headers', [])] \
+        or ['dx', 'pe', 'ou', 'value']
+    dx, pe, ou, value = [headers.index(name)
+                         for name in ('dx', 'pe', 'ou', 'value')]
+    rows = {}
+    for row in jsdata['rows']:
+        rows.setdefault(row[ou], []).append((row[dx], row[pe], row[value]))
+    return rows
+
+
+def fetch_rows(request):
+    """ fetch stage: (entities, params) to (entities, rows by org unit)
+
+        runs in a worker thread thus must not touch the database """
+    entities, params = request
+    return entities, rows_by_org_unit(get_dhis(path=UPATH, params=params))
+
+
 class Command(BaseCommand):
 
     option_list = BaseCommand.option_list + (
@@ -48,9 +85,15 @@ class Command(BaseCommand):
                     action='store_true',
                     default=False,
                     dest='debug'),
+        make_option('-w', '--workers',
+                    help="Number of concurrent requests to DHIS",
+                    action='store',
+                    type='int',
+                    default=settings.DHIS_MAX_WORKERS,
+                    dest='workers'),
     )
 
-    def handle_record(self, jsdata, entity, periods):
+    def handle_record(self, rows, entity, periods):
 
         logger.info(periods)
 
@@ -59,7 +102,7 @@ class Command(BaseCommand):
 
         # loop on rows
         indic_data = {(indic_id, pid): val
-                      for indic_id, pid, val in jsdata['rows']}
+                      for indic_id, pid, val in rows}
         for period in periods:
             pid = period.dhis_strid
 
@@ -93,7 +136,8 @@ class Command(BaseCommand):
         d = DataRecord.batch_create(data, dhisbot,
                                     source=DataRecord.DHIS,
                                     arrival_status=DataRecord.ARRIVED,
-                                    auto_validate=True)
+                                    auto_validate=True,
+                                    bulk=True)
         if self.debug:
             pp(d)
         return d
@@ -126,68 +170,51 @@ class Command(BaseCommand):
         else:
             periods = [period]
 
-        upath = '/analytics.json'
-
         indicators = {i.slug: (i.dhis_numerator_id, i.dhis_denominator_id)
                       for i in Indicator.get_all_dhis()}
         dhis_ids = list(set([v[0] for v in indicators.values()] +
                             [v[1] for v in indicators.values()]))
 
         drc = Entity.get_root()
-        params = {
-            'dimension': ['dx:{}'.format(";".join(dhis_ids)),
-                          'pe:{}'.format(
-                          ";".join([pe.dhis_strid for pe in periods]))],
-            'filter': 'ou:{}'.format(drc.dhis_id),
-            'displayProperty': 'NAME',
-            'outputIdScheme': 'ID',
-            'skipRounding': True,
-        }
-
-        logger.info(drc)
-        if update or self.no_record_at(entity=drc, period=period):
-            self.handle_record(get_dhis(path=upath, params=params),
-                               entity=drc, periods=periods)
-
-        for dps in drc.get_children():
-            logger.info(dps)
-
-            if not update and not self.no_record_at(entity=dps, period=period):
-                continue
-
-            dparams = copy.copy(params)
-            dparams.update({'filter': 'ou:{}'.format(dps.dhis_id)})
-            self.handle_record(get_dhis(path=upath, params=dparams),
-                               entity=dps, periods=periods)
-
-            # don't look for ZS if no data at DPS
-            if self.no_record_at(entity=dps, period=period):
-                continue
-
-            for zs in dps.get_children():
-                logger.info(zs)
-
-                if not update and not self.no_record_at(entity=zs,
-                                                        period=period):
-                    continue
-
-                zparams = copy.copy(params)
-                zparams.update({'filter': 'ou:{}'.format(zs.dhis_id)})
-                self.handle_record(get_dhis(path=upath, params=zparams),
-                                   entity=zs, periods=periods)
-
-                # don't look for ZS if no data at DPS
-                if self.no_record_at(entity=zs, period=period):
-                    continue
-
-                for aire in zs.get_children():
-                    logger.info(aire)
-
-                    if not update and not self.no_record_at(entity=aire,
-                                                            period=period):
-                        continue
-
-                    aparams = copy.copy(params)
-                    aparams.update({'filter': 'ou:{}'.format(aire.dhis_id)})
-                    self.handle_record(get_dhis(path=upath, params=aparams),
-                                       entity=aire, periods=periods)
+        workers = max([options.get('workers') or 1, 1])
+        chunk_size = settings.DHIS_OU_PER_REQUEST
+
+        entities = [drc]
+        pool = ThreadPool(workers)
+        try:
+            for level in range(NB_LEVELS):
+                fetched = [entity for entity in entities
+                           if update or self.no_record_at(entity=entity,
+                                                          period=period)]
+
+                # several org units per request, `workers` at a time
+                queries = [(chunk, analytics_params(dhis_ids, periods, chunk))
+                           for chunk in [fetched[i:i + chunk_size]
+                                         for i in range(0, len(fetched),
+                                                        chunk_size)]]
+
+                # DRC's children are always looked at
+                children = list(drc.get_children()) if not level else []
+                last_level = level == NB_LEVELS - 1
+
+                # write stage, as soon as each response arrives
+                for chunk, rows in pool.imap_unordered(fetch_rows, queries):
+                    for entity in chunk:
+                        logger.info(entity)
+                        self.handle_record(rows.get(entity.dhis_id, []),
+                                           entity=entity, periods=periods)
+
+                        # don't look for children if no data at entity
+                        if not level or last_level \
+                                or self.no_record_at(entity=entity,
+                                                     period=period):
+                            continue
+                        children += list(entity.get_children())
+
+                entities = children
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+            pool.join()
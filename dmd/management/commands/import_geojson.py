@@ -64,6 +64,7 @@ class Command(BaseCommand):
             logger.info(entity)
 
             entity.geometry = json.dumps(feature['geometry'])
+            entity.update_simplified_geometries()
             entity.save()
 
         logger.info("done.")
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import logging
+import multiprocessing
+import os
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import Max, Count
+from optparse import make_option
+
+from dmd.models.Periods import MonthPeriod
+from dmd.models.Entities import Entity, EntityTree
+from dmd.models.Indicators import Indicator
+from dmd.models.DataRecords import DataRecord
+from dmd.gis import (fname_for, gen_map_for, data_version, maps_dir,
+                     discard_versions_of, sweep_maps)
+from dmd.utils import chdir_dmd
+
+NB_RECENT_PERIODS = 2
+logger = logging.getLogger(__name__)
+
+
+def render_map(job):
+    ''' render a map (same as the png_map view would) to its file
+
+        job is a (entity_uuid, period_id, indicator_slug, fname) tuple.
+        written to a temporary file first so it's never served partly '''
+
+    entity_uuid, period_id, slug, fname = job
+    entity = EntityTree.get().get_entity(entity_uuid)
+    periods = [MonthPeriod.objects.get(id=period_id)]
+    indicator = Indicator.get_or_none(slug)
+
+    abspath = os.path.join(maps_dir(), fname)
+    tmp_path = "{}.{}.tmp".format(abspath, os.getpid())
+    gen_map_for(entity, periods, indicator, save_as=tmp_path,
+                with_title=True, with_index=True)
+    os.rename(tmp_path, abspath)
+    discard_versions_of(fname)
+    return job
+
+
+def data_versions_for(periods):
+    ''' data_version_for each (indicator, period, entity) at once
+
+        records of an entity are accounted for on its ancestors '''
+
+    tree = EntityTree.get()
+    states = {}
+    qs = DataRecord.objects.for_periods(periods) \
+        .values_list('indicator', 'period', 'entity') \
+        .annotate(last_change=Max('updated_on'), nb_records=Count('id'))
+    for indicator, period, entity, last_change, nb_records in qs:
+        for ancestor in tree.ancestors_of(entity, include_self=True):
+            key = (indicator, period, ancestor.uuid)
+            previous_change, previous_nb = states.get(key,
+                                                      (last_change, 0))
+            states[key] = (max([previous_change, last_change]),
+                           previous_nb + nb_records)
+    return {key: data_version(*state) for key, state in states.items()}
+
+
+class Command(BaseCommand):
+
+    option_list = BaseCommand.option_list + (
+        make_option('-n',
+                    help="Number of recent periods to render maps for",
+                    action='store',
+                    type='int',
+                    default=NB_RECENT_PERIODS,
+                    dest='nb_periods'),
+        make_option('-w', '--workers',
+                    help="Number of worker processes",
+                    action='store',
+                    type='int',
+                    default=1,
+                    dest='workers'),
+        make_option('-f',
+                    help="Render all maps, even if already rendered",
+                    action='store_true',
+                    default=False,
+                    dest='force'),
+    )
+
+    def handle(self, *args, **options):
+
+        # make sure we're at project root
+        chdir_dmd()
+
+        force = options.get('force')
+        workers = max([options.get('workers') or 1, 1])
+
+        periods = [MonthPeriod.current()]
+        while len(periods) < max([options.get('nb_periods'), 1]):
+            periods.insert(0, periods[0].previous())
+
+        # maps are available for entities with children
+        tree = EntityTree.get()
+        root = Entity.get_root()
+        entities = [root] + [entity for entity in tree.children_of(root.uuid)
+                             if tree.children_of(entity.uuid)]
+        indicators = list(Indicator.objects.all())
+
+        if not os.path.exists(maps_dir()):
+            os.makedirs(maps_dir())
+
+        versions = data_versions_for(periods)
+        empty_version = data_version(None, 0)
+        jobs = []
+        nb_skipped = 0
+        for period in periods:
+            for entity in entities:
+                for indicator in indicators:
+                    fname = fname_for(entity, [period], indicator,
+                                      version=versions.get(
+                                          (indicator.slug, period.id,
+                                           entity.uuid), empty_version))
+                    if not force and os.path.exists(
+                            os.path.join(maps_dir(), fname)):
+                        nb_skipped += 1
+                        continue
+                    jobs.append((entity.uuid, period.id, indicator.slug,
+                                 fname))
+
+        logger.info("Rendering {nb} maps ({s} up to date)..."
+                    .format(nb=len(jobs), s=nb_skipped))
+
+        if workers > 1:
+            # forked workers must not share the parent's connections
+            connections.close_all()
+            pool = multiprocessing.Pool(workers)
+            imap = pool.imap_unordered
+        else:
+            pool = None
+            imap = lambda func, items: (func(item) for item in items)
+
+        started_on = time.time()
+        nb_rendered = 0
+        try:
+            for job in imap(render_map, jobs):
+                nb_rendered += 1
+                logger.debug("{}/{} rendered".format(nb_rendered, len(jobs)))
+        except:
+            if pool is not None:
+                pool.terminate()
+            raise
+        else:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        duration = time.time() - started_on
+        logger.info("{nb} maps in {d:.1f}s ({r:.1f} maps/s)"
+                    .format(nb=nb_rendered, d=duration,
+                            r=nb_rendered / duration if duration else 0))
+
+        logger.info("{} least recently used maps removed."
+                    .format(sweep_maps()))
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import logging
+
+from django.core.management.base import BaseCommand
+
+from dmd.models.Aggregates import DataAggregate
+from dmd.utils import chdir_dmd
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    def handle(self, *args, **options):
+
+        # make sure we're at project root
+        chdir_dmd()
+
+        logger.info("Rebuilding DataAggregate table...")
+
+        nb_rows = DataAggregate.rebuild()
+
+        logger.info("done. {} aggregates.".format(nb_rows))
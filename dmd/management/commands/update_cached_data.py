@@ -5,107 +5,176 @@
 from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 import logging
-import sys
+import multiprocessing
+import time
 
 from django.core.management.base import BaseCommand
+from django.db import connections
+from optparse import make_option
 
 from dmd.models.Periods import MonthPeriod
 from dmd.models.Entities import Entity
 from dmd.models.Indicators import Indicator
-from dmd.caching import cache_exists_for, update_cached_data
+from dmd.caching import update_many_cached_data
+from dmd.models.Computations import ComputationResult
+from dmd.arrivals import completeness_matrix_for
 from dmd.utils import chdir_dmd
 
+NB_RECENT_PERIODS = 4
+CHECKPOINT_KEY = 'update_cached_data:checkpoint'
+PHASES = ['completeness', 'section2-arrivals', 'section2-points']
 logger = logging.getLogger(__name__)
 
 
+def update_shard(shard):
+    ''' fill missing entries of a phase for a period (all if checking)
+
+        shard is a (phase, period_id, check) tuple.
+        returns (shard, nb_keys, nb_stale) '''
+
+    phase, period_id, check = shard
+    period = MonthPeriod.objects.get(id=period_id)
+    root = Entity.get_root()
+    all_dps = list(root.get_children())
+    all_entities = all_dps + [root]
+    indicators = list(Indicator.objects.all())
+
+    if phase == 'completeness':
+        params_list = [{'dps': dps, 'indicator': indicator}
+                       for dps in all_dps
+                       for indicator in indicators + [None]]
+    elif phase == 'section2-arrivals':
+        params_list = [{'entity': entity, 'indicator': indicator}
+                       for entity in all_entities
+                       for indicator in indicators]
+    else:
+        params_list = [{'entity': entity} for entity in all_entities]
+
+    # all counts for the period at once
+    matrix = completeness_matrix_for(entities=all_entities,
+                                     periods=[period],
+                                     indicators=indicators)
+    # entries are invalidated on DataRecord changes so a cached
+    # entry is expected to be accurate.
+    stale = update_many_cached_data(
+        phase, [dict(period=period, **params) for params in params_list],
+        matrix=matrix, check=check)
+    for params in stale:
+        logger.warning("Stale cache entry for {k}: {p}"
+                       .format(k=phase, p=params))
+
+    return shard, len(params_list), len(stale)
+
+
+def shard_id(shard):
+    return "{}/{}/{}".format(shard[0], shard[1],
+                             'check' if shard[2] else 'fill')
+
+
+# checkpoint is stored as a plain ComputationResult: going through the
+# computations cache would have all workers drop their local entries.
+
+def get_checkpoint():
+    return ComputationResult.get_many([CHECKPOINT_KEY]) \
+        .get(CHECKPOINT_KEY) or set()
+
+
+def save_checkpoint(checkpoint):
+    ComputationResult.set_many({CHECKPOINT_KEY: checkpoint})
+
+
+def clear_checkpoint():
+    ComputationResult.delete_many([CHECKPOINT_KEY])
+
+
 class Command(BaseCommand):
 
+    option_list = BaseCommand.option_list + (
+        make_option('-c',
+                    help="Consistency check: recompute entries of the "
+                         "last {} periods even if cached"
+                         .format(NB_RECENT_PERIODS),
+                    action='store_true',
+                    default=False,
+                    dest='check'),
+        make_option('-w', '--workers',
+                    help="Number of worker processes",
+                    action='store',
+                    type='int',
+                    default=1,
+                    dest='workers'),
+        make_option('-r',
+                    help="Restart from scratch, ignoring checkpoint",
+                    action='store_true',
+                    default=False,
+                    dest='restart'),
+    )
+
     def handle(self, *args, **options):
 
         # make sure we're at project root
         chdir_dmd()
 
-        logger.info("Updating cache for dashboard completeness...")
+        check = options.get('check')
+        workers = max([options.get('workers') or 1, 1])
+
+        # (phase, period, mode) shards completed by an interrupted run
+        if options.get('restart'):
+            clear_checkpoint()
+        checkpoint = get_checkpoint()
+        if checkpoint:
+            logger.info("Resuming: {} shards already completed."
+                        .format(len(checkpoint)))
 
-        root = Entity.get_root()
         periods = MonthPeriod.all_till_now()
-        all_dps = root.get_children()
-        all_entities = list(all_dps) + [root]
-        indicators = Indicator.objects.all()
-        all_indicators = list(indicators) + [None]
-        nb_items = len(periods) * len(all_dps) * len(all_indicators)
-
-        nb_ran = 0
-        for period in periods:
-            # logger.debug("{}".format(period))
-            for dps in all_dps:
-                # logger.debug("== {}".format(dps))
-                for indicator in all_indicators:
-                    nb_ran += 1
-                    # logger.debug("==== {}".format(indicator))
-
-                    params = {
-                        'dps': dps,
-                        'period': period,
-                        'indicator': indicator
-                    }
-
-                    # existing cache 4months+ old are not regenerated
-                    if period <= periods[-4]:
-                        if cache_exists_for('completeness', **params):
-                            # logger.info("***** Skipping existing.")
-                            continue
-
-                    update_cached_data('completeness', **params)
-
-                    sys.stdout.write("{}/{} - {}%\r"
-                                     .format(nb_ran, nb_items,
-                                             int(nb_ran / nb_items * 100)))
-                    sys.stdout.flush()
-
-        logger.info("Updating cache for section2/arrivals...")
-
-        nb_items = len(periods) * len(all_dps) * len(indicators)
-        nb_ran = 0
-        for period in periods:
-            for entity in all_entities:
-                for indicator in indicators:
-                    params = {
-                        'entity': entity,
-                        'period': period,
-                        'indicator': indicator
-                    }
-                    if period <= periods[-4]:
-                        if cache_exists_for('section2-arrivals', **params):
-                            continue
-
-                        update_cached_data('section2-arrivals',
-                                           entity=entity,
-                                           period=period,
-                                           indicator=indicator)
-
-                        sys.stdout.write("{}/{} - {}%\r"
-                                         .format(nb_ran, nb_items,
-                                                 int(nb_ran / nb_items * 100)))
-                        sys.stdout.flush()
-
-        logger.info("Updating cache for section2/points")
-
-        nb_items = len(periods) * len(all_dps)
-        nb_ran = 0
-        for period in periods:
-            for entity in all_entities:
-                if period <= periods[-4]:
-                    if cache_exists_for('section2-points', **params):
-                        continue
-
-                    update_cached_data('section2-points',
-                                       entity=entity,
-                                       period=period)
-
-                    sys.stdout.write("{}/{} - {}%\r"
-                                     .format(nb_ran, nb_items,
-                                             int(nb_ran / nb_items * 100)))
-                    sys.stdout.flush()
+        recent_periods = periods[-NB_RECENT_PERIODS:]
+
+        if workers > 1:
+            # forked workers must not share the parent's connections
+            connections.close_all()
+            pool = multiprocessing.Pool(workers)
+            imap = pool.imap_unordered
+        else:
+            pool = None
+            imap = lambda func, items: (func(item) for item in items)
+
+        nb_stale = 0
+        try:
+            for phase in PHASES:
+                logger.info("Updating cache for {}...".format(phase))
+
+                shards = [(phase, period.id,
+                           check and period in recent_periods)
+                          for period in periods]
+                shards = [shard for shard in shards
+                          if shard_id(shard) not in checkpoint]
+
+                started_on = time.time()
+                nb_keys = 0
+                for shard, nb_shard_keys, nb_shard_stale \
+                        in imap(update_shard, shards):
+                    nb_keys += nb_shard_keys
+                    nb_stale += nb_shard_stale
+                    checkpoint.add(shard_id(shard))
+                    save_checkpoint(checkpoint)
+
+                duration = time.time() - started_on
+                logger.info("{phase}: {nb} keys in {d:.1f}s ({r:.1f} keys/s)"
+                            .format(phase=phase, nb=nb_keys, d=duration,
+                                    r=nb_keys / duration if duration else 0))
+        except:
+            if pool is not None:
+                pool.terminate()
+            raise
+        else:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        # complete run: next one starts over
+        clear_checkpoint()
+
+        if check:
+            logger.info("{} stale entries fixed.".format(nb_stale))
 
         logger.info("done.")
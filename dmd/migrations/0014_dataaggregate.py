@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def build_aggregates(apps, schema_editor):
+    Entity = apps.get_model('dmd', 'Entity')
+    DataRecord = apps.get_model('dmd', 'DataRecord')
+    DataAggregate = apps.get_model('dmd', 'DataAggregate')
+    parents = dict(Entity.objects.values_list('uuid', 'parent'))
+    etypes = dict(Entity.objects.values_list('uuid', 'etype'))
+    rows = {}
+    qs = DataRecord.objects \
+        .filter(validation_status__in=['validated', 'auto_validated',
+                                       'modified']) \
+        .values_list('indicator', 'period', 'entity',
+                     'numerator', 'denominator')
+    for indicator, period, entity, numerator, denominator in qs.iterator():
+        level = etypes[entity]
+        ancestor = entity
+        while ancestor is not None:
+            key = (indicator, ancestor, period, level)
+            nb, num, denom = rows.get(key, (0, 0, 0))
+            rows[key] = (nb + 1, num + numerator, denom + denominator)
+            ancestor = parents[ancestor]
+    DataAggregate.objects.bulk_create(
+        [DataAggregate(indicator_id=indicator, entity_id=entity,
+                       period_id=period, level=level, nb_records=nb,
+                       numerator_sum=num, denominator_sum=denom)
+         for (indicator, entity, period, level), (nb, num, denom)
+         in rows.items()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dmd', '0013_auto_20160217_1100'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataAggregate',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('level', models.CharField(max_length=64, choices=[('pays', 'Country'), ('division_provinciale_sante', 'Division Provinciale de la Sant\xe9'), ('zone_sante', 'Zone de sant\xe9')])),
+                ('nb_records', models.PositiveIntegerField(default=0)),
+                ('numerator_sum', models.FloatField(default=0)),
+                ('denominator_sum', models.FloatField(default=0)),
+                ('updated_on', models.DateTimeField(auto_now=True)),
+                ('entity', models.ForeignKey(related_name='aggregates', to='dmd.Entity')),
+                ('indicator', models.ForeignKey(related_name='aggregates', to='dmd.Indicator')),
+                ('period', models.ForeignKey(related_name='aggregates', to='dmd.MonthPeriod')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='dataaggregate',
+            unique_together=set([('indicator', 'entity', 'period', 'level')]),
+        ),
+        migrations.RunPython(build_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def simplify_geometries(apps, schema_editor):
+    from dmd.geometry import simplified_geometries
+    Entity = apps.get_model('dmd', 'Entity')
+    for entity in Entity.objects.exclude(geometry=None):
+        simplified = simplified_geometries(entity.geometry)
+        Entity.objects.filter(uuid=entity.uuid).update(
+            geometry_low=simplified['low'],
+            geometry_medium=simplified['medium'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dmd', '0014_dataaggregate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entity',
+            name='geometry_low',
+            field=models.TextField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='entity',
+            name='geometry_medium',
+            field=models.TextField(null=True, blank=True),
+        ),
+        migrations.RunPython(simplify_geometries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def set_ordinals(apps, schema_editor):
+    MonthPeriod = apps.get_model('dmd', 'MonthPeriod')
+    DataRecord = apps.get_model('dmd', 'DataRecord')
+    for period in MonthPeriod.objects.all():
+        ordinal = int(period.year) * 12 + int(period.month) - 1
+        MonthPeriod.objects.filter(id=period.id).update(ordinal=ordinal)
+        DataRecord.objects.filter(period_id=period.id) \
+                          .update(period_ordinal=ordinal)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dmd', '0015_simplified_geometries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='monthperiod',
+            name='ordinal',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='datarecord',
+            name='period_ordinal',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.RunPython(set_ordinals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dmd', '0016_period_ordinals'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='monthperiod',
+            name='ordinal',
+            field=models.PositiveIntegerField(unique=True),
+        ),
+        migrations.AlterField(
+            model_name='datarecord',
+            name='period_ordinal',
+            field=models.PositiveIntegerField(),
+        ),
+        migrations.AlterIndexTogether(
+            name='datarecord',
+            index_together=set([('indicator', 'entity', 'period_ordinal')]),
+        ),
+    ]
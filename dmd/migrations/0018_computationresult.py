@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dmd', '0017_period_ordinals_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ComputationResult',
+            fields=[
+                ('key', models.CharField(max_length=250, serialize=False, primary_key=True)),
+                ('version', models.PositiveSmallIntegerField(default=1)),
+                ('payload', models.BinaryField()),
+                ('computed_on', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dmd', '0018_computationresult'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ComputationLock',
+            fields=[
+                ('key', models.CharField(max_length=250, serialize=False, primary_key=True)),
+                ('owner', models.CharField(max_length=64)),
+                ('acquired_on', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
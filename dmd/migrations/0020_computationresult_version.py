@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dmd', '0019_computationlock'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='computationresult',
+            name='version',
+            field=models.PositiveSmallIntegerField(),
+        ),
+    ]
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import logging
+
+from django.db import models, transaction
+from django.db.models import Sum
+from django.dispatch import receiver
+
+from dmd.models.Entities import Entity, EntityTree
+from dmd.models.DataRecords import DataRecord
+from dmd.signals import records_changed
+
+logger = logging.getLogger(__name__)
+
+
+class DataAggregate(models.Model):
+    """ validated DataRecord values rolled-up on an entity for a period
+
+        `level` is the type of the aggregated records' entities:
+        the row for an entity at its own level holds its own record while
+        rows at lower levels hold the sum of its descendants' records. """
+
+    class Meta:
+        app_label = 'dmd'
+        unique_together = (('indicator', 'entity', 'period', 'level'),)
+
+    indicator = models.ForeignKey('Indicator', related_name='aggregates')
+    entity = models.ForeignKey('Entity', related_name='aggregates')
+    period = models.ForeignKey('MonthPeriod', related_name='aggregates')
+    level = models.CharField(max_length=64, choices=Entity.TYPES.items())
+
+    nb_records = models.PositiveIntegerField(default=0)
+    numerator_sum = models.FloatField(default=0)
+    denominator_sum = models.FloatField(default=0)
+
+    updated_on = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.__unicode__().encode('utf-8')
+
+    def __unicode__(self):
+        return "{i}@{p}/{e}/{l}".format(i=self.indicator_id,
+                                        p=self.period_id,
+                                        e=self.entity_id,
+                                        l=self.level)
+
+    @property
+    def numerator_avg(self):
+        return self.numerator_sum / self.nb_records \
+            if self.nb_records else 0
+
+    @property
+    def denominator_avg(self):
+        return self.denominator_sum / self.nb_records \
+            if self.nb_records else 0
+
+    @classmethod
+    def summary_for(cls, indicator, entity, periods, level=None):
+        """ (nb_records, numerator_sum, denominator_sum) over periods """
+        data = cls.objects.filter(indicator=indicator, entity=entity,
+                                  level=level or entity.etype,
+                                  period__in=periods) \
+                          .aggregate(nb_records=Sum('nb_records'),
+                                     numerator_sum=Sum('numerator_sum'),
+                                     denominator_sum=Sum('denominator_sum'))
+        return (data['nb_records'] or 0,
+                data['numerator_sum'] or 0,
+                data['denominator_sum'] or 0)
+
+    @classmethod
+    def summaries_for(cls, indicator, entities, periods):
+        """ summary_for each entity at its own level, in a single query """
+        entities = list(entities)
+        summaries = {entity.uuid: (0, 0, 0) for entity in entities}
+        levels = {entity.uuid: entity.etype for entity in entities}
+        qs = cls.objects.filter(indicator=indicator,
+                                entity__in=entities,
+                                level__in=set(levels.values()),
+                                period__in=periods) \
+                        .values('entity', 'level') \
+                        .annotate(nb_records=Sum('nb_records'),
+                                  numerator_sum=Sum('numerator_sum'),
+                                  denominator_sum=Sum('denominator_sum'))
+        for row in qs:
+            if levels[row['entity']] != row['level']:
+                continue
+            summaries[row['entity']] = (row['nb_records'],
+                                        row['numerator_sum'],
+                                        row['denominator_sum'])
+        return summaries
+
+    @classmethod
+    def update_for(cls, idents):
+        """ recompute rows depending on (indicator, period, entity) idents
+
+            rows sharing an indicator, a period and a level are recomputed
+            together: one query for their records, one to replace them. """
+        tree = EntityTree.get()
+
+        targets = {}
+        for indicator_id, period_id, entity_uuid in idents:
+            level = tree.get_entity(entity_uuid).etype
+            targets.setdefault((indicator_id, period_id, level), set()) \
+                .update([ancestor.uuid for ancestor in
+                         tree.ancestors_of(entity_uuid, include_self=True)])
+
+        with transaction.atomic():
+            for (indicator_id, period_id, level), ancestors \
+                    in targets.items():
+                sources = set([descendant.uuid
+                               for ancestor in ancestors
+                               for descendant in tree.descendants_of(
+                                   ancestor, include_self=True)
+                               if descendant.etype == level])
+                qs = DataRecord.objects.valid() \
+                    .filter(indicator=indicator_id, period=period_id,
+                            entity__in=sources) \
+                    .values_list('entity', 'numerator', 'denominator')
+
+                rows = {}
+                for entity, numerator, denominator in qs.iterator():
+                    for ancestor in tree.ancestors_of(entity,
+                                                      include_self=True):
+                        if ancestor.uuid not in ancestors:
+                            continue
+                        nb, num, denom = rows.get(ancestor.uuid, (0, 0, 0))
+                        rows[ancestor.uuid] = (nb + 1, num + numerator,
+                                               denom + denominator)
+
+                cls.objects.filter(indicator=indicator_id, period=period_id,
+                                   level=level,
+                                   entity__in=ancestors).delete()
+                cls.objects.bulk_create(
+                    [cls(indicator_id=indicator_id, entity_id=entity,
+                         period_id=period_id, level=level, nb_records=nb,
+                         numerator_sum=num, denominator_sum=denom)
+                     for entity, (nb, num, denom) in rows.items()])
+
+    @classmethod
+    def rebuild(cls):
+        """ recompute the whole table from validated DataRecord """
+        tree = EntityTree.get()
+        rows = {}
+        qs = DataRecord.objects.valid() \
+            .values_list('indicator', 'period', 'entity',
+                         'numerator', 'denominator')
+        for indicator, period, entity, numerator, denominator in qs.iterator():
+            level = tree.get_entity(entity).etype
+            for ancestor in tree.ancestors_of(entity, include_self=True):
+                key = (indicator, ancestor.uuid, period, level)
+                nb, num, denom = rows.get(key, (0, 0, 0))
+                rows[key] = (nb + 1, num + numerator, denom + denominator)
+
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(
+                [cls(indicator_id=indicator, entity_id=entity,
+                     period_id=period, level=level, nb_records=nb,
+                     numerator_sum=num, denominator_sum=denom)
+                 for (indicator, entity, period, level), (nb, num, denom)
+                 in rows.items()])
+
+        return len(rows)
+
+
+@receiver(records_changed)
+def records_changed_handler(sender, records, **kwargs):
+    DataAggregate.update_for(set([(record.indicator_id, record.period_id,
+                                   record.entity_id) for record in records]))
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import logging
+import zlib
+from datetime import timedelta
+
+from django.db import models, transaction, IntegrityError
+from django.utils import timezone
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# rows per query (keeps queries under the DB's parameters limit)
+BATCH_SIZE = 500
+logger = logging.getLogger(__name__)
+
+
+def batches_of(items, size=BATCH_SIZE):
+    items = list(items)
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
+
+
+class ComputationResult(models.Model):
+    """ a precomputed value (completeness, arrivals...) stored by key
+
+        payload is a zlib-compressed pickle (of primitive tuples, see
+        dmd.caching). rows of another PAYLOAD_VERSION are ignored
+        so the format can evolve.
+        there is no expiration nor culling: rows are deleted
+        when the records they depend on change. """
+
+    class Meta:
+        app_label = 'dmd'
+
+    PAYLOAD_VERSION = 2
+
+    key = models.CharField(max_length=250, primary_key=True)
+    # always PAYLOAD_VERSION when written
+    version = models.PositiveSmallIntegerField()
+    payload = models.BinaryField()
+    computed_on = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.key
+
+    @classmethod
+    def encode(cls, value):
+        return zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    @classmethod
+    def decode(cls, payload):
+        return pickle.loads(zlib.decompress(bytes(payload)))
+
+    @classmethod
+    def get_many(cls, keys):
+        """ {key: value} of the keys having a result """
+        data = {}
+        for batch in batches_of(keys):
+            qs = cls.objects.filter(key__in=batch,
+                                    version=cls.PAYLOAD_VERSION) \
+                            .values_list('key', 'payload')
+            data.update({key: cls.decode(payload) for key, payload in qs})
+        return data
+
+    @classmethod
+    def set_many(cls, data):
+        """ insert or replace results of a {key: value} dict
+
+            returns the keys which had a row (replaced) """
+        now = timezone.now()
+        replaced = set()
+        for batch in batches_of(data.keys()):
+            results = [cls(key=key, version=cls.PAYLOAD_VERSION,
+                           payload=cls.encode(data[key]), computed_on=now)
+                       for key in batch]
+            try:
+                with transaction.atomic():
+                    existing = cls.objects.filter(key__in=batch)
+                    replaced.update(existing.values_list('key', flat=True))
+                    existing.delete()
+                    cls.objects.bulk_create(results)
+            except IntegrityError:
+                # concurrently inserted: replace one by one
+                for result in results:
+                    _, created = cls.objects.update_or_create(
+                        key=result.key,
+                        defaults={'version': result.version,
+                                  'payload': result.payload,
+                                  'computed_on': result.computed_on})
+                    if not created:
+                        replaced.add(result.key)
+        return replaced
+
+    @classmethod
+    def add(cls, key, value):
+        """ store a result unless one exists. returns whether it did """
+        if cls.objects.filter(key=key,
+                              version=cls.PAYLOAD_VERSION).exists():
+            return False
+        try:
+            with transaction.atomic():
+                cls.objects.filter(key=key).delete()
+                cls.objects.create(key=key, version=cls.PAYLOAD_VERSION,
+                                  payload=cls.encode(value))
+        except IntegrityError:
+            return False
+        return True
+
+    @classmethod
+    def delete_many(cls, keys):
+        for batch in batches_of(keys):
+            cls.objects.filter(key__in=batch).delete()
+
+
+class ComputationLock(models.Model):
+    """ a ComputationResult being computed by a worker
+
+        inserting the row for a key acquires its lock so that concurrent
+        misses compute it once. locks older than TIMEOUT seconds are
+        considered abandoned (crashed worker). """
+
+    class Meta:
+        app_label = 'dmd'
+
+    TIMEOUT = 120
+
+    key = models.CharField(max_length=250, primary_key=True)
+    owner = models.CharField(max_length=64)
+    acquired_on = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.key
+
+    @classmethod
+    def acquire_many(cls, keys, owner):
+        """ lock the keys not already locked. returns those locked """
+        acquired = set()
+        expired_on = timezone.now() - timedelta(seconds=cls.TIMEOUT)
+        for batch in batches_of(set(keys)):
+            cls.objects.filter(key__in=batch,
+                               acquired_on__lt=expired_on).delete()
+            held = set(cls.objects.filter(key__in=batch)
+                                  .values_list('key', flat=True))
+            free = [key for key in batch if key not in held]
+            try:
+                with transaction.atomic():
+                    cls.objects.bulk_create([cls(key=key, owner=owner)
+                                             for key in free])
+                acquired.update(free)
+            except IntegrityError:
+                # concurrently locked: one at a time
+                for key in free:
+                    try:
+                        with transaction.atomic():
+                            cls.objects.create(key=key, owner=owner)
+                        acquired.add(key)
+                    except IntegrityError:
+                        pass
+        return acquired
+
+    @classmethod
+    def release_many(cls, keys, owner):
+        for batch in batches_of(keys):
+            cls.objects.filter(key__in=batch, owner=owner).delete()
@@ -6,12 +6,16 @@ from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 import logging
 
-from django.db import models, transaction
+from django.db import models, transaction, connections
+from django.db.models import Case, When, Value, FloatField
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 from dmd.models.Partners import Partner
 from dmd.models.Indicators import Indicator
+from dmd.signals import records_changed
 
 logger = logging.getLogger(__name__)
 
@@ -36,6 +40,17 @@ class DRStatusQuerySet(models.QuerySet):
     def modified(self):
         return self.filter(validation_status=DataRecord.MODIFIED)
 
+    def for_periods(self, periods):
+        """ records of periods, with a range on period_ordinal if possible
+
+            a BETWEEN on the (indicator, entity, period_ordinal) index
+            replaces a long IN list for consecutive periods """
+        ordinals = sorted(set([period.ordinal for period in periods]))
+        if ordinals and ordinals[-1] - ordinals[0] + 1 == len(ordinals):
+            return self.filter(period_ordinal__range=(ordinals[0],
+                                                      ordinals[-1]))
+        return self.filter(period__in=periods)
+
 
 class DataRecord(models.Model):
 
@@ -73,13 +88,20 @@ class DataRecord(models.Model):
 
     VALIDATED_STATUSES = [VALIDATED, AUTO_VALIDATED, MODIFIED]
 
+    # query parameters bound per record by bulk_record_update:
+    # its id and an (id, value) pair for both numerator and denominator
+    BULK_UPDATE_PARAMS = 5
+
     class Meta:
         app_label = 'dmd'
         unique_together = (('indicator', 'period', 'entity'),)
+        index_together = (('indicator', 'entity', 'period_ordinal'),)
 
     indicator = models.ForeignKey('Indicator', related_name='data_records')
     period = models.ForeignKey('MonthPeriod', related_name='data_records')
     entity = models.ForeignKey('Entity', related_name='data_records')
+    # copy of period.ordinal for range queries, see for_periods
+    period_ordinal = models.PositiveIntegerField()
 
     numerator = models.FloatField()
     denominator = models.FloatField()
@@ -118,6 +140,18 @@ class DataRecord(models.Model):
     def __unicode__(self):
         return "{i}@{p}".format(i=self.indicator, p=self.period)
 
+    def save(self, *args, **kwargs):
+        ''' save, sending records_changed unless notify=False
+
+            callers saving several records notify them at once '''
+        notify = kwargs.pop('notify', True)
+        # records never change period
+        if self.period_ordinal is None:
+            self.period_ordinal = self.period.ordinal
+        super(DataRecord, self).save(*args, **kwargs)
+        if notify:
+            self.notify_changes([self])
+
     @property
     def source_verbose(self):
         return self.SOURCES.get(self.source)
@@ -187,9 +221,17 @@ class DataRecord(models.Model):
     def batch_create(cls, data, partner,
                      source=UPLOAD,
                      arrival_status=None,
-                     auto_validate=False):
+                     auto_validate=False,
+                     bulk=False):
+
+        if bulk:
+            return cls.bulk_batch_create(data, partner,
+                                         source=source,
+                                         arrival_status=arrival_status,
+                                         auto_validate=auto_validate)
 
         now = timezone.now()
+        changed = []
 
         # make sure we can rollback if something goes wrong
         with transaction.atomic():
@@ -224,10 +266,10 @@ class DataRecord(models.Model):
 
                     dr.numerator = num
                     dr.denominator = denum
-                    dr.record_update(partner)
+                    dr.record_update(partner, notify=False)
                 elif dr and dr.source == dr.UPLOAD and source == dr.DHIS:
                     # mark data as updated by DHIS even though it's identical
-                    dr.record_update(partner)
+                    dr.record_update(partner, notify=False)
 
                 elif dr is None:
                     old_values = None
@@ -237,9 +279,105 @@ class DataRecord(models.Model):
                         arrival_status = indic.arrival_status_on(
                             on=now, period=period)
 
-                    dr = cls.objects.create(
+                    dr = cls(indicator=indic,
+                             period=period,
+                             entity=entity,
+                             numerator=num,
+                             denominator=denum,
+                             source=source,
+                             created_by=partner)
+                    dr.save(force_insert=True, notify=False)
+
+                    if auto_validate:
+                        dr.auto_validate(on=now, notify=False)
+                else:
+                    # new data are identical to datarecord
+                    continue
+
+                changed.append(dr)
+                data[ident].update({
+                    'action': action,
+                    'id': dr.id,
+                    'previous': old_values})
+
+        cls.notify_changes(changed)
+
+        return data
+
+    @classmethod
+    def bulk_batch_create(cls, data, partner,
+                          source=UPLOAD,
+                          arrival_status=None,
+                          auto_validate=False):
+        ''' same as batch_create but with a fixed number of queries
+
+            existing records are fetched at once, new ones are inserted
+            with bulk_create and updated ones as many at a time as
+            the database accepts parameters (see bulk_update_batch_size) '''
+
+        now = timezone.now()
+        changed = []
+        reported = []
+        to_create = []
+        to_update = {}
+
+        points = [(ident, dp) for ident, dp in data.items()
+                  if ident != 'errors']
+
+        validation_bot = Partner.validation_bot() if auto_validate else None
+        indicators = Indicator.objects.in_bulk(
+            set([dp['slug'] for _, dp in points]))
+        existing = {
+            (dr.indicator_id, dr.period_id, dr.entity_id): dr
+            for dr in cls.objects.select_related('indicator', 'period')
+            .filter(indicator__in=indicators.keys(),
+                    period__in=set([dp['period'] for _, dp in points]),
+                    entity__in=set([dp['entity'] for _, dp in points]))}
+
+        with transaction.atomic():
+
+            for ident, dp in points:
+
+                slug = dp['slug']
+                period = dp['period']
+                entity = dp['entity']
+
+                indic = indicators.get(slug)
+                key = (slug, period.id, entity.uuid)
+                dr = existing.get(key)
+
+                num = dp['numerator']
+                denum = dp['denominator']
+
+                if dr and (dr.numerator != num or dr.denominator != denum):
+
+                    # do not manualy update DHIS data
+                    if dr.source == dr.DHIS and source == dr.UPLOAD:
+                        continue
+
+                    old_values = {'numerator': dr.numerator,
+                                  'denominator': dr.denominator}
+                    action = 'updated'
+
+                    dr.numerator = num
+                    dr.denominator = denum
+                    to_update[dr.id] = dr
+                elif dr and dr.source == dr.UPLOAD and source == dr.DHIS:
+                    # mark data as updated by DHIS even though it's identical
+                    to_update[dr.id] = dr
+
+                elif dr is None:
+                    old_values = None
+                    action = 'created'
+
+                    if arrival_status is None:
+                        arrival_status = indic.arrival_status_on(
+                            on=now, period=period)
+
+                    dr = cls(
                         indicator=indic,
                         period=period,
+                        period_ordinal=period.ordinal,
                         entity=entity,
                         numerator=num,
                         denominator=denum,
@@ -247,18 +385,90 @@ class DataRecord(models.Model):
                         created_by=partner)
 
                     if auto_validate:
-                        dr.auto_validate(on=now)
+                        dr.validation_status = cls.AUTO_VALIDATED
+                        dr.validated_on = now
+                        dr.validated_by = validation_bot
+
+                    to_create.append(dr)
                 else:
                     # new data are identical to datarecord
                     continue
 
+                changed.append(dr)
+                reported.append(ident)
                 data[ident].update({
                     'action': action,
-                    'id': dr.id,
                     'previous': old_values})
 
+            to_update = to_update.values()
+            batch_size = cls.bulk_update_batch_size(to_update)
+            for index in range(0, len(to_update), batch_size):
+                cls.bulk_record_update(
+                    to_update[index:index + batch_size],
+                    partner, on=now)
+
+            if to_create:
+                # batch size is the DB's (SQLite binds 999 parameters max)
+                cls.objects.bulk_create(to_create)
+
+                # bulk_create does not retrieve primary keys
+                ids = {(dr.indicator_id, dr.period_id, dr.entity_id): dr.id
+                       for dr in cls.objects.filter(
+                           indicator__in=indicators.keys(),
+                           period__in=set([dr.period_id
+                                           for dr in to_create]),
+                           entity__in=set([dr.entity_id
+                                           for dr in to_create]))
+                       .only('id', 'indicator', 'period', 'entity')}
+                for dr in to_create:
+                    dr.id = ids[(dr.indicator_id, dr.period_id,
+                                 dr.entity_id)]
+
+        for ident, dr in zip(reported, changed):
+            data[ident]['id'] = dr.id
+
+        cls.notify_changes(changed)
+
         return data
 
+    @classmethod
+    def bulk_update_batch_size(cls, records):
+        ''' records per bulk_record_update within the DB's parameters limit
+
+            one more parameter per record accounts for the fixed ones '''
+        ops = connections[cls.objects.db].ops
+        return max(ops.bulk_batch_size([None] * (cls.BULK_UPDATE_PARAMS + 1),
+                                       records), 1)
+
+    @classmethod
+    def bulk_record_update(cls, records, partner, on):
+        ''' record_update() on several records with a single UPDATE '''
+        if not records:
+            return
+        cls.objects.filter(id__in=[dr.id for dr in records]).update(
+            numerator=Case(*[When(id=dr.id, then=Value(dr.numerator))
+                             for dr in records],
+                           output_field=FloatField()),
+            denominator=Case(*[When(id=dr.id, then=Value(dr.denominator))
+                               for dr in records],
+                             output_field=FloatField()),
+            updated_on=on,
+            updated_by=partner,
+            validation_status=cls.NOT_VALIDATED,
+            validated_on=None,
+            validated_by=None)
+        for dr in records:
+            dr.updated_on = on
+            dr.updated_by = partner
+            dr.validation_status = cls.NOT_VALIDATED
+            dr.validated_on = None
+            dr.validated_by = None
+
+    @classmethod
+    def notify_changes(cls, records):
+        if records:
+            records_changed.send(sender=cls, records=records)
+
     @classmethod
     def get_for(cls, period, entity, indicator):
 
@@ -277,38 +487,43 @@ class DataRecord(models.Model):
             for child in entity.get_children()
         }
 
-    def record_validation(self, status, on, by):
+    def record_validation(self, status, on, by, notify=True):
         self.validation_status = status
         self.validated_on = on
         self.validated_by = by
-        self.save()
+        self.save(notify=notify)
 
-    def remove_validation(self):
-        self.record_validation(status=self.NOT_VALIDATED, on=None, by=None)
+    def remove_validation(self, notify=True):
+        self.record_validation(status=self.NOT_VALIDATED, on=None, by=None,
+                               notify=notify)
 
-    def validate(self, on, by):
-        self.record_validation(status=self.VALIDATED, on=on, by=by)
+    def validate(self, on, by, notify=True):
+        self.record_validation(status=self.VALIDATED, on=on, by=by,
+                               notify=notify)
 
-    def reject(self, on, by):
-        self.record_validation(status=self.REJECTED, on=on, by=by)
+    def reject(self, on, by, notify=True):
+        self.record_validation(status=self.REJECTED, on=on, by=by,
+                               notify=notify)
 
-    def auto_validate(self, on):
+    def auto_validate(self, on, notify=True):
         self.record_validation(status=self.AUTO_VALIDATED, on=on,
-                               by=Partner.validation_bot())
+                               by=Partner.validation_bot(), notify=notify)
 
-    def record_update(self, partner, keep_validation=False):
+    def record_update(self, partner, keep_validation=False, notify=True):
         self.updated_on = timezone.now()
         self.updated_by = partner
         if not keep_validation:
-            self.remove_validation()
-        self.save()
+            self.remove_validation(notify=False)
+        self.save(notify=notify)
 
     def edit(self, on, by, numerator, denominator):
         with transaction.atomic():
             self.numerator = numerator
             self.denominator = denominator
-            self.record_update(by)
-            self.record_validation(status=self.MODIFIED, on=on, by=by)
+            self.record_update(by, notify=False)
+            self.record_validation(status=self.MODIFIED, on=on, by=by,
+                                   notify=False)
+        self.notify_changes([self])
 
     def human(self):
         return self.indicator.format_value(value=self.value,
@@ -340,3 +555,9 @@ class DataRecord(models.Model):
         val_dl = self.validation_deadline
 
         return on > val_dl if val_dl is not None else False
+
+
+@receiver(post_delete, sender=DataRecord)
+def record_deleted_handler(sender, instance, **kwargs):
+    # deletions (admin, cascades) are not otherwise notified
+    DataRecord.notify_changes([instance])
@@ -8,9 +8,12 @@ import logging
 import json
 import uuid
 import re
+import time
 from collections import OrderedDict
 
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 from mptt.models import MPTTModel, TreeForeignKey
 from py3compat import text_type
@@ -34,6 +37,12 @@ class Entity(MPTTModel):
     AIRE = 'aire_sante'
     CENTRE = 'centre_sante'
 
+    # levels of detail of the geometry, from the coarsest
+    DETAIL_LOW = 'low'
+    DETAIL_MEDIUM = 'medium'
+    DETAIL_FULL = 'full'
+    DETAILS = [DETAIL_LOW, DETAIL_MEDIUM, DETAIL_FULL]
+
     TYPES = OrderedDict([
         (PAYS, _("Country")),
         (PROVINCE, _("Division Provinciale de la Santé")),
@@ -65,6 +74,9 @@ class Entity(MPTTModel):
     latitude = models.FloatField(blank=True, null=True)
     longitude = models.FloatField(blank=True, null=True)
     geometry = models.TextField(blank=True, null=True)
+    # simplified copies of `geometry`, see update_simplified_geometries
+    geometry_low = models.TextField(blank=True, null=True)
+    geometry_medium = models.TextField(blank=True, null=True)
 
     def __str__(self):
         return self.__unicode__().encode('utf-8')
@@ -96,22 +108,54 @@ class Entity(MPTTModel):
 
     @property
     def geojson(self):
+        return self.geojson_for(self.DETAIL_FULL)
+
+    @property
+    def children_geojson(self):
+        return self.children_geojson_for(self.DETAIL_FULL)
+
+    @classmethod
+    def geometry_field_for(cls, detail):
+        return 'geometry' if detail == cls.DETAIL_FULL \
+            else 'geometry_{}'.format(detail)
+
+    def geometry_for(self, detail):
+        """ geometry text at a level of detail (full one if missing) """
+        return getattr(self, self.geometry_field_for(detail)) \
+            or self.geometry
+
+    def geojson_for(self, detail):
+        geometry = self.geometry_for(detail)
         return {
             "type": "Feature",
             "properties": self.to_dict(),
-            "geometry": json.loads(self.geometry) if self.geometry else None
+            "geometry": json.loads(geometry) if geometry else None
         }
 
-    @property
-    def children_geojson(self):
+    def children_geojson_for(self, detail):
+        # only load the geometry to be sent (and the full one as fallback)
+        children = self.get_children().defer(
+            *[self.geometry_field_for(other) for other in self.DETAILS
+              if other not in (detail, self.DETAIL_FULL)])
         return {
             "type": "FeatureCollection",
-            "features": [child.geojson for child in self.get_children()]
+            "features": [child.geojson_for(detail) for child in children]
         }
 
+    def update_simplified_geometries(self):
+        """ (re)compute the simplified geometries from `geometry` """
+        from dmd.geometry import simplified_geometries
+        for detail, geometry in simplified_geometries(self.geometry).items():
+            setattr(self, self.geometry_field_for(detail), geometry)
+
     @property
     def lineage_data(self):
-        return {e.etype: e.uuid for e in self.get_ancestors()}
+        tree = EntityTree.get()
+        if self.uuid in tree:
+            ancestors = tree.ancestors_of(self.uuid)
+        else:
+            ancestors = self.get_ancestors()
+        return {e.etype: e.uuid for e in ancestors}
 
     @classmethod
     def get_root(cls):
@@ -214,14 +258,23 @@ class Entity(MPTTModel):
         return self.get_ancestor_of(self.AIRE)
 
     def get_ancestor_of(self, etype):
-        for ancestor in self.get_ancestors(include_self=True):
+        tree = EntityTree.get()
+        if self.uuid in tree:
+            ancestors = tree.ancestors_of(self.uuid, include_self=True)
+        else:
+            ancestors = self.get_ancestors(include_self=True)
+        for ancestor in ancestors:
             if ancestor.etype == etype:
                 return ancestor
         return None
 
     def get_descendants_of(self, etype):
-        return [descendant
-                for descendant in self.get_descendants(include_self=True)
+        tree = EntityTree.get()
+        if self.uuid in tree:
+            descendants = tree.descendants_of(self.uuid, include_self=True)
+        else:
+            descendants = self.get_descendants(include_self=True)
+        return [descendant for descendant in descendants
                 if descendant.etype == etype]
 
     def fields(self):
@@ -242,3 +295,121 @@ class Entity(MPTTModel):
         else:
             prefix = ''
         return self.uuid, "{prefix}{name}".format(prefix=prefix, name=self)
+
+
+class EntityTree(object):
+    """ in-memory snapshot of the whole Entity tree
+
+        Built from a single query, it resolves parent, children, ancestors
+        and descendants of an entity by uuid without SQL.
+        Saving or deleting an Entity bumps a version stored in Metadata.
+        The process' snapshot is dropped right away and other processes
+        reload theirs once they notice the new version,
+        at most CHECK_INTERVAL seconds later. """
+
+    VERSION_KEY = 'entities_version'
+    CHECK_INTERVAL = 60
+
+    _snapshot = None
+    _checked_on = None
+
+    def __init__(self, version=None):
+        self.version = version
+
+        # geometries are large and not needed for lineage
+        entities = list(Entity.objects.defer('geometry', 'geometry_low',
+                                             'geometry_medium')
+                                      .order_by('tree_id', 'lft'))
+
+        # uuids in tree order: descendants of an entity follow it
+        self.order = [entity.uuid for entity in entities]
+        self.positions = {entity_uuid: index for index, entity_uuid
+                          in enumerate(self.order)}
+        self.entities = {entity.uuid: entity for entity in entities}
+        self.parents = {entity.uuid: entity.parent_id for entity in entities}
+        self.children = {entity_uuid: [] for entity_uuid in self.order}
+        self.ancestors = {}
+        self.ends = {}
+
+        for entity in entities:
+            parent = entity.parent_id
+            if parent in self.entities:
+                self.children[parent].append(entity.uuid)
+                # avoids a query on `entity.parent`
+                setattr(entity, Entity._meta.get_field('parent')
+                        .get_cache_name(), self.entities[parent])
+                self.ancestors[entity.uuid] = self.ancestors[parent] \
+                    + [parent]
+            else:
+                self.ancestors[entity.uuid] = []
+
+        # position following the last descendant of each entity
+        for entity_uuid in reversed(self.order):
+            self.ends[entity_uuid] = max(
+                [self.positions[entity_uuid] + 1] +
+                [self.ends[child] for child in self.children[entity_uuid]])
+
+    def __contains__(self, uuid):
+        return uuid in self.entities
+
+    @classmethod
+    def get(cls, version=None):
+        """ current snapshot, reloaded if its version is outdated
+
+            passing the shared version, when already known, reloads an
+            outdated snapshot right away instead of CHECK_INTERVAL later """
+        now = time.time()
+        if version is not None and cls._snapshot is not None \
+                and cls._snapshot.version != version:
+            cls._checked_on = None
+        if cls._snapshot is None or cls._checked_on is None \
+                or now - cls._checked_on > cls.CHECK_INTERVAL:
+            version = cls.shared_version()
+            cls._checked_on = now
+            if cls._snapshot is None or cls._snapshot.version != version:
+                cls._snapshot = cls(version=version)
+        return cls._snapshot
+
+    @classmethod
+    def shared_version(cls):
+        from dmd.models import Metadata
+        md = Metadata.get_or_none(cls.VERSION_KEY)
+        return md.value if md is not None else None
+
+    @classmethod
+    def bump_version(cls):
+        from dmd.models import Metadata
+        Metadata.update(cls.VERSION_KEY, uuid.uuid4().hex)
+        cls._snapshot = None
+
+    def get_entity(self, uuid):
+        return self.entities.get(uuid)
+
+    def parent_of(self, uuid):
+        return self.entities.get(self.parents[uuid])
+
+    def children_of(self, uuid):
+        return [self.entities[child] for child in self.children[uuid]]
+
+    def ancestors_of(self, uuid, include_self=False):
+        """ ancestors from the root down, like `get_ancestors()` """
+        uuids = self.ancestors[uuid] + ([uuid] if include_self else [])
+        return [self.entities[ancestor] for ancestor in uuids]
+
+    def descendants_of(self, uuid, include_self=False):
+        """ descendants in tree order, like `get_descendants()` """
+        start = self.positions[uuid] + (0 if include_self else 1)
+        return [self.entities[descendant]
+                for descendant in self.order[start:self.ends[uuid]]]
+
+    def ancestor_of(self, uuid, etype):
+        for ancestor in self.ancestors_of(uuid, include_self=True):
+            if ancestor.etype == etype:
+                return ancestor
+        return None
+
+
+@receiver(post_save, sender=Entity)
+@receiver(post_delete, sender=Entity)
+def entity_changed_handler(sender, **kwargs):
+    EntityTree.bump_version()
@@ -6,9 +6,11 @@ from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 import logging
 import datetime
+import uuid
 
-import numpy
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 from babel.numbers import format_decimal
 
@@ -24,6 +26,9 @@ class Indicator(models.Model):
         app_label = 'dmd'
         ordering = ['number', 'name']
 
+    # Metadata key of a version changed on every save or delete
+    VERSION_KEY = 'indicators_version'
+
     PVC = 'pvc'
     CM = 'cm'
     BCC = 'bcc'
@@ -398,46 +403,58 @@ class Indicator(models.Model):
 
     def data_for(self, entity, periods):
         from dmd.models.DataRecords import DataRecord
-        qs = self.data_records.filter(entity=entity) \
-            .filter(validation_status__in=DataRecord.VALIDATED_STATUSES)
+        from dmd.models.Aggregates import DataAggregate
         if len(periods) == 1:
+            qs = self.data_records.filter(entity=entity) \
+                .filter(validation_status__in=DataRecord.VALIDATED_STATUSES)
             dr = qs.get(period=periods[-1])
             return dr.to_dict()
         else:
-            drs = qs.filter(period__in=periods)
-            numerators = [dr.numerator for dr in drs]
-            num_sum = sum(numerators)
-            num_avg = numpy.mean(numerators) if numerators else 0
-            denominators = [dr.denominator for dr in drs]
-            denom_sum = sum(denominators)
-            denom_avg = numpy.mean(denominators) if denominators else 0
-            try:
-                value = self.compute_value(num_sum, denom_sum)
-            except ZeroDivisionError:
-                value = None
-            return {
-                # meta-data
-                'kind': 'year-aggregate',
-                'indicator': self,
-                'period': None,
-                'has_data': qs.count() > 0,
-                # 'year': year,
-                'periods': periods,
-                'entity': entity,
-
-                'numerator_sum': num_sum,
-                'denominator_sum': denom_sum,
-                'numerator_avg': num_avg,
-                'denominator_avg': denom_avg,
-
-                'numerator_sum_fmt': self.format_number(num_sum),
-                'denominator_sum_fmt': self.format_number(denom_sum),
-                'numerator_avg_fmt': self.format_number(num_avg),
-                'denominator_avg_fmt': self.format_number(denom_avg),
-
-                'value': value,
-                'formatted': self.format_number(value),
-                'human': self.format_value(value=value,
-                                           numerator=num_sum,
-                                           denominator=denom_sum)
-            }
+            return self.aggregate_data_for(
+                entity, periods,
+                summary=DataAggregate.summary_for(self, entity, periods),
+                has_data=self.aggregates.filter(
+                    entity=entity, level=entity.etype).exists())
+
+    def aggregate_data_for(self, entity, periods, summary, has_data):
+        """ periods aggregate dict from a DataAggregate summary """
+        nb_records, num_sum, denom_sum = summary
+        num_avg = num_sum / nb_records if nb_records else 0
+        denom_avg = denom_sum / nb_records if nb_records else 0
+        try:
+            value = self.compute_value(num_sum, denom_sum)
+        except ZeroDivisionError:
+            value = None
+        return {
+            # meta-data
+            'kind': 'year-aggregate',
+            'indicator': self,
+            'period': None,
+            'has_data': has_data,
+            # 'year': year,
+            'periods': periods,
+            'entity': entity,
+
+            'numerator_sum': num_sum,
+            'denominator_sum': denom_sum,
+            'numerator_avg': num_avg,
+            'denominator_avg': denom_avg,
+
+            'numerator_sum_fmt': self.format_number(num_sum),
+            'denominator_sum_fmt': self.format_number(denom_sum),
+            'numerator_avg_fmt': self.format_number(num_avg),
+            'denominator_avg_fmt': self.format_number(denom_avg),
+
+            'value': value,
+            'formatted': self.format_number(value),
+            'human': self.format_value(value=value,
+                                       numerator=num_sum,
+                                       denominator=denom_sum)
+        }
+
+
+@receiver(post_save, sender=Indicator)
+@receiver(post_delete, sender=Indicator)
+def indicator_changed_handler(sender, **kwargs):
+    from dmd.models import Metadata
+    Metadata.update(Indicator.VERSION_KEY, uuid.uuid4().hex)
@@ -7,9 +7,10 @@ from __future__ import (unicode_literals, absolute_import,
 import logging
 import datetime
 import calendar
+import threading
 from collections import OrderedDict
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
 
 logger = logging.getLogger(__name__)
 
@@ -27,6 +28,8 @@ class MonthPeriod(models.Model):
 
     year = models.CharField(max_length=4, choices=YEARS.items())
     month = models.CharField(max_length=2, choices=MONTHS.items())
+    # months since year 0 (consecutive months follow), see ordinal_for
+    ordinal = models.PositiveIntegerField(unique=True)
 
     def __str__(self):
         return self.__unicode__().encode('utf-8')
@@ -37,6 +40,10 @@ class MonthPeriod(models.Model):
     def to_tuple(self):
         return (self.strid, self)
 
+    def save(self, *args, **kwargs):
+        self.ordinal = self.ordinal_for(self.year, self.month)
+        super(MonthPeriod, self).save(*args, **kwargs)
+
     @property
     def iyear(self):
         return int(self.year)
@@ -67,28 +74,30 @@ class MonthPeriod(models.Model):
         nbd = calendar.monthrange(self.iyear, self.imonth)[1]
         return self.start_on + datetime.timedelta(days=nbd - 1, seconds=86399)
 
+    @classmethod
+    def ordinal_for(cls, year, month):
+        """ ordinal of a (year, month), ValueError if out of bounds """
+        y = str(year).zfill(2)
+        m = str(month).zfill(2)
+        if y not in cls.YEARS.values():
+            raise ValueError("Out of bound year")
+        if m not in cls.MONTHS.values():
+            raise ValueError("Out of bound month")
+        return int(y) * 12 + int(m) - 1
+
     @classmethod
     def get_or_none(cls, period_str):
         # make sure we understand both regular and DHIS
         period_str = period_str.replace('-', '')
         year = period_str[:4]
         month = period_str[4:]
-        try:
-            return cls.objects.get(year=year, month=month)
-        except cls.DoesNotExist:
+        if year not in cls.YEARS or month not in cls.MONTHS:
             return None
+        return PeriodCalendar.get(cls.ordinal_for(year, month))
 
     @classmethod
     def get_or_create(cls, year, month):
-        y = str(year).zfill(2)
-        m = str(month).zfill(2)
-        if y not in cls.YEARS.values():
-            raise ValueError("Out of bound year")
-        if m not in cls.MONTHS.values():
-            raise ValueError("Out of bound month")
-
-        p, _ = cls.objects.get_or_create(year=y, month=m)
-        return p
+        return PeriodCalendar.get_or_create(cls.ordinal_for(year, month))
 
     @classmethod
     def find_create_from(cls, adate):
@@ -100,7 +109,7 @@ class MonthPeriod(models.Model):
 
     @classmethod
     def all_till_now(cls, descending=False):
-        pfrom = MonthPeriod.objects.first()
+        pfrom = PeriodCalendar.first()
         l = cls.all_from(pfrom, None)
         if descending:
             return reversed(l)
@@ -112,15 +121,10 @@ class MonthPeriod(models.Model):
             period_to = cls.current()
         if period_from > period_to:
             raise ValueError("Period From is after Period To")
-        period = period_from
-        periods = []
-        while period <= period_to:
-            periods.append(period)
-            try:
-                period = period.following()
-            except ValueError:
-                break
-        return periods
+        # periods stop at the last month of YEARS
+        last = cls.ordinal_for(cls.YEARS.keys()[-1], 12)
+        return PeriodCalendar.get_range(period_from.ordinal,
+                                        min([period_to.ordinal, last]))
 
     def previous(self):
         if self.imonth == 1:
@@ -142,37 +146,109 @@ class MonthPeriod(models.Model):
 
     def __lt__(self, other):
         try:
-            return self.end_on < other.start_on
+            return self.ordinal < other.ordinal
         except:
             return NotImplemented
 
     def __le__(self, other):
         try:
-            return self.end_on <= other.end_on
+            return self.ordinal <= other.ordinal
         except:
             return NotImplemented
 
     def __eq__(self, other):
         try:
-            return self.strid == other.strid
+            return self.ordinal == other.ordinal
         except:
             return NotImplemented
 
     def __ne__(self, other):
         try:
-            return self.start_on != other.start_on \
-                or self.end_on != other.end_on
+            return self.ordinal != other.ordinal
         except:
             return NotImplemented
 
     def __gt__(self, other):
         try:
-            return self.start_on > other.end_on
+            return self.ordinal > other.ordinal
         except:
             return NotImplemented
 
     def __ge__(self, other):
         try:
-            return self.start_on >= other.start_on
+            return self.ordinal >= other.ordinal
         except:
             return NotImplemented
+
+
+class PeriodCalendar(object):
+    """ process-wide cache of MonthPeriod instances by ordinal
+
+        All periods are loaded at once, and again only when one is not
+        found. Missing periods of a range are created with a single
+        bulk INSERT. Periods are never edited once created so cached
+        instances do not get outdated. """
+
+    _periods = None
+    _lock = threading.RLock()
+
+    @classmethod
+    def load(cls):
+        cls._periods = {period.ordinal: period
+                        for period in MonthPeriod.objects.all()}
+
+    @classmethod
+    def get(cls, ordinal):
+        """ period of ordinal if it exists, None otherwise """
+        if cls._periods is None or ordinal not in cls._periods:
+            with cls._lock:
+                cls.load()
+        return cls._periods.get(ordinal)
+
+    @classmethod
+    def get_or_create(cls, ordinal):
+        return cls.get_range(ordinal, ordinal)[0]
+
+    @classmethod
+    def get_range(cls, first, last):
+        """ periods from ordinal first to last (included), created if needed
+
+            ordinals must be valid (see MonthPeriod.ordinal_for) """
+        ordinals = range(first, last + 1)
+        periods = cls._periods
+        if periods is None or not all([ordinal in periods
+                                       for ordinal in ordinals]):
+            with cls._lock:
+                cls.load()
+                cls.create([ordinal for ordinal in ordinals
+                            if ordinal not in cls._periods])
+                periods = cls._periods
+        return [periods[ordinal] for ordinal in ordinals]
+
+    @classmethod
+    def create(cls, ordinals):
+        if not ordinals:
+            return
+        fields = [{'year': str(ordinal // 12),
+                   'month': str(ordinal % 12 + 1).zfill(2)}
+                  for ordinal in ordinals]
+        try:
+            with transaction.atomic():
+                MonthPeriod.objects.bulk_create(
+                    [MonthPeriod(ordinal=ordinal, **kwargs)
+                     for ordinal, kwargs in zip(ordinals, fields)])
+        except IntegrityError:
+            # some were created concurrently by another process
+            for kwargs in fields:
+                MonthPeriod.objects.get_or_create(**kwargs)
+        # bulk_create does not set ids
+        cls.load()
+
+    @classmethod
+    def first(cls):
+        """ earliest existing period """
+        if cls._periods is None:
+            with cls._lock:
+                cls.load()
+        return cls._periods[min(cls._periods.keys())] \
+            if cls._periods else None
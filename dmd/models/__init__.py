@@ -10,6 +10,8 @@ from django.db import models
 from py3compat import text_type
 
 from dmd.models.DataRecords import DataRecord
+from dmd.models.Aggregates import DataAggregate
+from dmd.models.Computations import ComputationResult, ComputationLock
 from dmd.models.Entities import Entity
 from dmd.models.Indicators import Indicator
 from dmd.models.Partners import Organization, Partner
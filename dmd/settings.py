@@ -152,11 +152,13 @@ CACHES = {
         'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
     },
     'computations': {
-        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
-        'LOCATION': 'computations_cache',
+        # ComputationResult rows
+        'BACKEND': 'dmd.cache_backends.LayeredComputationResultCache',
         'TIMEOUT': None,
         'OPTIONS': {
-            'MAX_ENTRIES': 1000000
+            # per-process LRU in front of the table
+            'LOCAL_MAX_ENTRIES': 20000,
+            'VERSION_CHECK_INTERVAL': 1,
         }
     }
 }
@@ -195,6 +197,9 @@ ALL_EXPORT_XLSX_FNAME = 'BDD-PNLP-tous.xlsx'
 ALL_EXPORT_PATH = os.path.join(EXPORT_REPOSITORY, ALL_EXPORT_FNAME)
 ALL_EXPORT_XLSX_PATH = os.path.join(EXPORT_REPOSITORY, ALL_EXPORT_XLSX_FNAME)
 
+# disk space for rendered maps, least recently used removed first
+PNG_MAP_CACHE_MAX_SIZE = 512 * 1024 * 1024
+
 SITE_ID = 1
 DOMAIN_USES_HTTPS = False
 
@@ -204,6 +209,12 @@ SUB_PATH = None
 DHIS_BASE_URL = 'https://snisrdc.com'
 DHIS_USER = 'Guest'
 DHIS_PASSWORD = 'Guest'
+# concurrent requests to DHIS and org units per analytics request
+DHIS_MAX_WORKERS = 4
+DHIS_OU_PER_REQUEST = 20
+DHIS_MAX_RETRIES = 3
+DHIS_RETRY_BACKOFF = 1
+DHIS_TIMEOUT = 120
 
 EMAIL_HOST = 'localhost'
 EMAIL_PORT = 25
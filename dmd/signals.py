@@ -0,0 +1,14 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import logging
+
+from django.dispatch import Signal
+
+logger = logging.getLogger(__name__)
+
+# sent by DataRecord once values or validation of records changed
+records_changed = Signal(providing_args=['records'])
@@ -7,6 +7,9 @@ function getEntitiesBrowser (options) {
 
         this.parentID = options.parentID || null;
         this.baseURL = options.baseURL || "/api/entities/getchildren";
+        // children of all the selectable entities, fetched in one request
+        this.lineageURL = options.lineageURL || null;
+        this.lineageChildren = {};
         this.lineage = options.lineage || ["pays","centre_sante","division_provinciale_sante","zone_sante","aire_sante"];
         this.auto_launch = options.auto_launch || false;
         this.lineage_data = options.lineage_data || [];
@@ -34,17 +37,52 @@ function getEntitiesBrowser (options) {
 
         // launch
         if (this.auto_launch) {
-            var first_level = this.lineage[0];
-            var first_select = this.getSelectFor(first_level);
-            console.log(first_select);
-            var selected_value = this.selectedValueFor(first_level);
-            console.log("marking " + first_level + " select with " + selected_value);
-            this.setSelectedOn(first_select, selected_value);
-            first_select.change();
+            var manager = this;
+            if (this.lineageURL === null) {
+                this.launch();
+            } else {
+                $.get(this.lineageURL)
+                    .success(function (data) {
+                        manager.storeLineage(data);
+                        manager.launch();
+                    })
+                    .error(function () { manager.launch(); });
+            }
         }
 
     }
 
+    EntitiesBrowser.prototype.launch = function () {
+        var first_level = this.lineage[0];
+        var first_select = this.getSelectFor(first_level);
+        console.log(first_select);
+        var selected_value = this.selectedValueFor(first_level);
+        console.log("marking " + first_level + " select with " + selected_value);
+        this.setSelectedOn(first_select, selected_value);
+        first_select.change();
+    };
+
+    EntitiesBrowser.prototype.storeLineage = function (data) {
+        var manager = this;
+        $.each(data.children, function (parent, rows) {
+            manager.lineageChildren[parent] = $.map(rows, function (row) {
+                var entity = {};
+                $.each(data.fields, function (index, field) {
+                    entity[field] = row[index];
+                });
+                return entity;
+            });
+        });
+    };
+
+    EntitiesBrowser.prototype.withChildrenOf = function (parent, callback) {
+        if (this.lineageChildren[parent] !== undefined) {
+            callback(this.lineageChildren[parent]);
+        } else {
+            $.get(this.baseURL + "/" + parent).success(callback);
+        }
+    };
+
     EntitiesBrowser.prototype.getEntitySlug = function () {
         for (var i=this.lineage.length - 1; i >= 0 ; i--) {
             var entity = this.getSelectFor(this.lineage[i]).val();
@@ -121,32 +159,31 @@ function getEntitiesBrowser (options) {
             }
 
             // fetch data for next level in lineage and parent = selected
-            $.get(manager.baseURL + "/" + selected)
-                .success(function (data) {
-
-                    // grab and reset the select for new slug
-                    var selectElem = manager.clearSelect(manager.getSelectFor(next_type_slug));
-
-                    // exit if no data
-                    if (data[0] === undefined) {
-                        return;
-                    }
-
-                    // populate with fetched data
-                    $.each(data, function (index, entity) {
-                        var option = $('<option />');
-                        option.val(entity.uuid);
-                        option.text(entity.short_name);
-                        selectElem.append(option);
-                    });
-
-                    // mark selected if exists
-                    var selected_value = manager.selectedValueFor(next_type_slug);
-                    if (selected_value !== null) {
-                        manager.setSelectedOn(selectElem, selected_value);
-                        // selectElem.children("option[value="+ selected_value +"]").attr('selected', 'selected');
-                        selectElem.change();
-                    }
+            manager.withChildrenOf(selected, function (data) {
+
+                // grab and reset the select for new slug
+                var selectElem = manager.clearSelect(manager.getSelectFor(next_type_slug));
+
+                // exit if no data
+                if (data[0] === undefined) {
+                    return;
+                }
+
+                // populate with fetched data
+                $.each(data, function (index, entity) {
+                    var option = $('<option />');
+                    option.val(entity.uuid);
+                    option.text(entity.short_name);
+                    selectElem.append(option);
+                });
+
+                // mark selected if exists
+                var selected_value = manager.selectedValueFor(next_type_slug);
+                if (selected_value !== null) {
+                    manager.setSelectedOn(selectElem, selected_value);
+                    // selectElem.children("option[value="+ selected_value +"]").attr('selected', 'selected');
+                    selectElem.change();
+                }
             });
         });
         console.log("registered onChange");
@@ -37,6 +37,9 @@ urlpatterns = [
         '(?P<parent_uuid>[A-Za-z0-9\_\-]{36})/?$',
         api_views.get_entity_children,
         name='api_entities_get_children'),
+    url(r'^' + uprefix + 'api/entities/lineage/?$',
+        api_views.get_entities_lineage,
+        name='api_entities_lineage'),
     url(r'^' + uprefix + 'api/entities/'
         '(?P<entity_uuid>[A-Za-z0-9\_\-]{36})/?$',
         api_views.get_entity_detail,
@@ -125,6 +128,8 @@ urlpatterns = [
         misc_views.serve_exported_files, name='exported_files'),
     url(r'^' + uprefix + 'export/?$', raw_data_views.data_export,
         name='export'),
+    url(r'^' + uprefix + 'export/csv/?$', raw_data_views.data_export_csv,
+        name='export_csv'),
 
     # pivot table
     url(r'^' + uprefix + 'pivot_table/?$', raw_data_views.pivot_table,
@@ -20,7 +20,7 @@ from dmd.models.Entities import Entity
 from dmd.models.Indicators import Indicator
 from dmd.views.common import process_period_filter, process_entity_filter
 from dmd.analysis.section1 import get_timed_records
-from dmd.caching import get_cached_data
+from dmd.caching import get_many_cached_data
 
 
 logger = logging.getLogger(__name__)
@@ -97,14 +97,13 @@ def dashboard(request, entity_uuid=None, indicator_slug=None,
     all_indicators = Indicator.get_all_sorted()  # Indicator.get_all_routine()
     indicator = Indicator.get_or_none(indicator_slug)
 
+    children = list(root.get_children())
     context.update({
         'root': root,
-        'completeness': OrderedDict([
-            (child, get_cached_data('completeness',
-                                    dps=child, period=context['period'],
-                                    indicator=indicator))
-            for child in root.get_children()
-        ]),
+        'completeness': OrderedDict(zip(children, get_many_cached_data(
+            'completeness', [{'dps': child, 'period': context['period'],
+                              'indicator': indicator}
+                             for child in children]))),
         'indicators': all_indicators,
         'indicator': indicator,
         'lineage': [Entity.PROVINCE]
@@ -5,24 +5,124 @@
 from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 import logging
+import hashlib
 import json
 import os
+import re
+import uuid
 
+from django.db.models import Max, Count
 from django.http import JsonResponse, HttpResponse, Http404
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_string
 from django.utils.translation import ugettext as _
-from django.conf import settings
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from py3compat import text_type
 
-from dmd.views.common import process_period_filter
 from dmd.views.misc import serve_exported_files
-from dmd.models.Entities import Entity
+from dmd.models import Metadata
+from dmd.models.Entities import Entity, EntityTree
 from dmd.models.Periods import MonthPeriod
 from dmd.models.Indicators import Indicator
 from dmd.models.DataRecords import DataRecord
-from dmd.gis import fname_for, gen_map_for
+from dmd.gis import (fname_for, gen_map_for, data_version_for, maps_dir,
+                     touch_map, discard_versions_of, sweep_maps)
 
 logger = logging.getLogger(__name__)
+re_accepts_gzip = re.compile(r'\bgzip\b')
 
 
+def versions_of(request):
+    """ (value, updated_on) of Entity and Indicator versions in Metadata
+
+        queried once per request as both ETag and Last-Modified need it """
+    if not hasattr(request, '_dmd_versions'):
+        versions = {key: (None, None) for key in (EntityTree.VERSION_KEY,
+                                                  Indicator.VERSION_KEY)}
+        versions.update({
+            key: (value, updated_on) for key, value, updated_on
+            in Metadata.objects.filter(key__in=versions.keys())
+                               .values_list('key', 'value', 'updated_on')})
+        request._dmd_versions = versions
+    return request._dmd_versions
+
+
+def aware(date):
+    """ datetimes are naive local ones but Last-Modified must be in UTC """
+    if date is None or timezone.is_aware(date):
+        return date
+    return timezone.make_aware(date, timezone.get_default_timezone())
+
+
+def etag_for(*parts):
+    return hashlib.md5("/".join(["{}".format(part) for part in parts])) \
+        .hexdigest()
+
+
+def accepts_gzip(request):
+    return bool(re_accepts_gzip.search(
+        request.META.get('HTTP_ACCEPT_ENCODING', '')))
+
+
+def entities_etag(request, *args, **kwargs):
+    return etag_for('entities',
+                    versions_of(request)[EntityTree.VERSION_KEY][0])
+
+
+def entities_last_modified(request, *args, **kwargs):
+    return aware(versions_of(request)[EntityTree.VERSION_KEY][1])
+
+
+def geojson_etag(request, *args, **kwargs):
+    # gzipped and plain bodies are different representations
+    return etag_for('geojson',
+                    versions_of(request)[EntityTree.VERSION_KEY][0],
+                    get_geometry_detail(request), accepts_gzip(request))
+
+
+def indicators_etag(request, *args, **kwargs):
+    return etag_for('indicators',
+                    versions_of(request)[Indicator.VERSION_KEY][0])
+
+
+def indicators_last_modified(request, *args, **kwargs):
+    return aware(versions_of(request)[Indicator.VERSION_KEY][1])
+
+
+class GZippedGeoJSON(object):
+    """ process-wide cache of gzipped geojson bodies
+
+        geojson only changes with entities so bodies are compressed once
+        and dropped when the EntityTree version changes. """
+
+    _version = None
+    _bodies = {}
+
+    @classmethod
+    def response_for(cls, request, key, build):
+        """ JSON response of build(), gzipped if the client accepts it """
+        if not accepts_gzip(request):
+            response = JsonResponse(build(), safe=False)
+        else:
+            version = versions_of(request)[EntityTree.VERSION_KEY][0]
+            if version != cls._version:
+                cls._version = version
+                cls._bodies = {}
+            if key not in cls._bodies:
+                cls._bodies[key] = compress_string(
+                    JsonResponse(build(), safe=False).content)
+            response = HttpResponse(cls._bodies[key],
+                                    content_type='application/json')
+            response['Content-Encoding'] = 'gzip'
+            response['Content-Length'] = str(len(cls._bodies[key]))
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+
+@cache_control(no_cache=True)
+@condition(etag_func=entities_etag, last_modified_func=entities_last_modified)
 def get_entity_detail(request, entity_uuid=None):
     entity = Entity.get_or_none(entity_uuid)
 
@@ -34,37 +134,112 @@ def get_entity_detail(request, entity_uuid=None):
     return JsonResponse(data, safe=False)
 
 
+def entity_tree_for(request):
+    """ EntityTree matching the version the ETag was computed from """
+    return EntityTree.get(version=versions_of(request)
+                          [EntityTree.VERSION_KEY][0])
+
+
+def uuid_or_404(value):
+    try:
+        return uuid.UUID(value)
+    except (TypeError, ValueError):
+        raise Http404(_("Unknown entity UUID `{u}`").format(u=value))
+
+
+@cache_control(no_cache=True)
+@condition(etag_func=entities_etag, last_modified_func=entities_last_modified)
 def get_entity_children(request, parent_uuid=None):
     """ generic view to build json results of entities children list """
+    tree = entity_tree_for(request)
+    parent_uuid = uuid_or_404(parent_uuid)
+    if parent_uuid not in tree:
+        raise Http404(_("Unknown entity UUID `{u}`").format(u=parent_uuid))
 
     return HttpResponse(json.dumps(
-        [Entity.get_or_none(e.uuid).to_dict()
-         for e in Entity.get_or_none(parent_uuid).get_children()]),
+        [child.to_dict() for child in tree.children_of(parent_uuid)]),
         content_type='application/json')
 
 
-def single_geojson(request, entity_uuid):
-    entity = Entity.get_or_none(entity_uuid)
+@cache_control(no_cache=True)
+@condition(etag_func=entities_etag, last_modified_func=entities_last_modified)
+def get_entities_lineage(request):
+    """ children of several entities at once, from the EntityTree
 
-    if entity is None:
-        data = None
+        either those of `?parents=uuid,uuid` or those of `?root=uuid`
+        and its descendants down to `?depth=` levels below it
+        (default: down to the last type of Entity.TYPES).
+        {"fields": [...], "children": {parent_uuid: [[values], ...]}} """
+    tree = entity_tree_for(request)
+    fields = ['uuid', 'name', 'short_name', 'display_name', 'etype']
+
+    if request.GET.get('parents'):
+        parents = [uuid_or_404(parent) for parent
+                   in request.GET.get('parents').split(',')]
     else:
-        data = entity.geojson
+        root = uuid_or_404(request.GET.get('root')) \
+            if request.GET.get('root') else Entity.get_root().uuid
+        if root not in tree:
+            raise Http404(_("Unknown entity UUID `{u}`").format(u=root))
+        try:
+            depth = int(request.GET.get('depth') or
+                        len(Entity.TYPES) - 1 - tree.get_entity(root).level)
+        except ValueError:
+            raise Http404(_("Invalid depth `{d}`")
+                          .format(d=request.GET.get('depth')))
+        max_level = tree.get_entity(root).level + depth
+        parents = [descendant.uuid for descendant
+                   in tree.descendants_of(root, include_self=True)
+                   if descendant.level < max_level]
+
+    return JsonResponse({
+        'fields': fields,
+        'children': {
+            text_type(parent): [[text_type(getattr(child, field))
+                                 for field in fields]
+                                for child in tree.children_of(parent)]
+            for parent in parents if parent in tree}
+    })
+
+
+def get_geometry_detail(request):
+    """ level of detail of geometries requested via `?detail=` """
+    detail = request.GET.get('detail') or Entity.DETAIL_FULL
+    if detail not in Entity.DETAILS:
+        raise Http404(_("Unknown detail level `{d}`").format(d=detail))
+    return detail
+
+
+@cache_control(no_cache=True)
+@condition(etag_func=geojson_etag, last_modified_func=entities_last_modified)
+def single_geojson(request, entity_uuid):
+    detail = get_geometry_detail(request)
 
-    return JsonResponse(data, safe=False)
+    def build():
+        entity = Entity.get_or_none(entity_uuid)
+        return entity.geojson_for(detail) if entity is not None else None
+
+    return GZippedGeoJSON.response_for(
+        request, ('single', entity_uuid, detail), build)
 
 
+@cache_control(no_cache=True)
+@condition(etag_func=geojson_etag, last_modified_func=entities_last_modified)
 def children_geojson(request, parent_uuid):
-    parent = Entity.get_or_none(parent_uuid)
+    detail = get_geometry_detail(request)
 
-    if parent is None:
-        data = None
-    else:
-        data = parent.children_geojson
+    def build():
+        parent = Entity.get_or_none(parent_uuid)
+        return parent.children_geojson_for(detail) \
+            if parent is not None else None
 
-    return JsonResponse(data, safe=False)
+    return GZippedGeoJSON.response_for(
+        request, ('children', parent_uuid, detail), build)
 
 
+@cache_control(no_cache=True)
+@condition(etag_func=indicators_etag,
+           last_modified_func=indicators_last_modified)
 def indicator_list(request, col_type):
 
     if col_type not in Indicator.COLLECTION_TYPES.keys():
@@ -76,27 +251,72 @@ def indicator_list(request, col_type):
     return JsonResponse(data, safe=False)
 
 
-def json_data_record_for(request, period_str, entity_uuid, indicator_slug):
+def data_record_params(request, period_str, entity_uuid, indicator_slug):
+    """ (period, entity, indicator) of a data_record request """
+    if not hasattr(request, '_dmd_params'):
+        entity = Entity.get_or_none(entity_uuid)
+        if entity is None:
+            raise Http404(_("Unknown entity UUID `{u}`")
+                          .format(u=entity_uuid))
 
-    entity = Entity.get_or_none(entity_uuid)
-    if entity is None:
-        raise Http404(_("Unknown entity UUID `{u}`").format(u=entity_uuid))
+        period = MonthPeriod.get_or_none(period_str)
+        if period is None:
+            raise Http404(_("Unknown period `{p}`").format(p=period_str))
+
+        indicator = Indicator.get_or_none(indicator_slug)
+        if indicator is None:
+            raise Http404(_("Unknown indicator `{s}`")
+                          .format(s=indicator_slug))
+
+        request._dmd_params = (period, entity, indicator)
+    return request._dmd_params
+
+
+def data_record_state(request, *args, **kwargs):
+    """ (last_change, nb_records) of the records a data_record depends on """
+    if not hasattr(request, '_dmd_state'):
+        period, entity, indicator = data_record_params(request,
+                                                       *args, **kwargs)
+        data = DataRecord.objects.filter(indicator=indicator, period=period,
+                                         entity__parent=entity) \
+                                 .aggregate(last_change=Max('updated_on'),
+                                            nb_records=Count('id'))
+        request._dmd_state = (data['last_change'], data['nb_records'])
+    return request._dmd_state
+
+
+def data_record_etag(request, *args, **kwargs):
+    return etag_for('data-record',
+                    versions_of(request)[EntityTree.VERSION_KEY][0],
+                    versions_of(request)[Indicator.VERSION_KEY][0],
+                    *data_record_state(request, *args, **kwargs))
 
-    period = process_period_filter(request, period_str, 'period').get('period')
-    if period is None:
-        raise Http404(_("Unknown period `{p}`").format(p=period_str))
 
-    indicator = Indicator.get_or_none(indicator_slug)
-    if indicator is None:
-        raise Http404(_("Unknown indicator `{s}`").format(s=indicator_slug))
+def data_record_last_modified(request, *args, **kwargs):
+    dates = [versions_of(request)[key][1]
+             for key in (EntityTree.VERSION_KEY, Indicator.VERSION_KEY)] \
+        + [data_record_state(request, *args, **kwargs)[0]]
+    dates = [aware(date) for date in dates if date is not None]
+    return max(dates) if dates else None
+
+
+@cache_control(no_cache=True)
+@condition(etag_func=data_record_etag,
+           last_modified_func=data_record_last_modified)
+def json_data_record_for(request, period_str, entity_uuid, indicator_slug):
+
+    period, entity, indicator = data_record_params(
+        request, period_str, entity_uuid, indicator_slug)
 
     return JsonResponse(DataRecord.get_for(period, entity, indicator),
                         safe=False)
 
 
-def png_map_for(request, perioda_str, periodb_str,
-                entity_name, indicator_number,
-                with_title=True, with_legend=True):
+def png_map_params(request, perioda_str, periodb_str,
+                   entity_name, indicator_number, **kwargs):
+    """ (entity, periods, indicator, fname) of a png_map request """
+    if hasattr(request, '_dmd_params'):
+        return request._dmd_params
 
     entity = Entity.get_by_short_name(entity_name)
     if entity is None:
@@ -107,15 +327,12 @@ def png_map_for(request, perioda_str, periodb_str,
             and indicator_number is None:
         periods = None
         indicator = None
-        with_title = False
         fname = "initial.png"
     else:
-        with_title = True
-        perioda = process_period_filter(
-            request, perioda_str, 'perioda').get('perioda')
-        periodb = process_period_filter(
-            request, periodb_str, 'periodb').get('periodb')
-        periods = MonthPeriod.all_from(perioda, periodb)
+        perioda = MonthPeriod.get_or_none(perioda_str)
+        periodb = MonthPeriod.get_or_none(periodb_str)
+        periods = MonthPeriod.all_from(perioda, periodb) \
+            if perioda is not None and periodb is not None else []
         if not len(periods):
             raise Http404(_("Unknown period interval `{pa}` `{pb}`")
                           .format(pa=perioda_str, pb=periodb_str))
@@ -125,20 +342,51 @@ def png_map_for(request, perioda_str, periodb_str,
             raise Http404(_("Unknown indicator `{s}`")
                           .format(s=indicator_number))
 
-        fname = fname_for(entity, periods, indicator)
+        # a new version is rendered once data changes
+        fname = fname_for(entity, periods, indicator,
+                          version=data_version_for(entity, periods,
+                                                   indicator))
+
+    request._dmd_params = (entity, periods, indicator, fname)
+    return request._dmd_params
+
+
+def png_map_etag(request, *args, **kwargs):
+    return etag_for('png-map',
+                    versions_of(request)[EntityTree.VERSION_KEY][0],
+                    versions_of(request)[Indicator.VERSION_KEY][0],
+                    png_map_params(request, *args, **kwargs)[-1])
+
+
+@cache_control(no_cache=True)
+@condition(etag_func=png_map_etag)
+def png_map_for(request, perioda_str, periodb_str,
+                entity_name, indicator_number,
+                with_title=True, with_legend=True):
+
+    entity, periods, indicator, fname = png_map_params(
+        request, perioda_str, periodb_str, entity_name, indicator_number)
+    with_title = indicator is not None
 
     fpath = os.path.join('png_map', fname)
-    abspath = os.path.join(settings.EXPORT_REPOSITORY, fpath)
+    abspath = os.path.join(maps_dir(), fname)
 
     if not os.path.exists(abspath):
+        tmp_path = "{}.{}.tmp".format(abspath, uuid.uuid4().hex)
         try:
             gen_map_for(entity, periods, indicator,
-                        save_as=abspath,
+                        save_as=tmp_path,
                         with_title=with_title,
                         with_index=with_title)
         except IOError:
             logger.error("Missing map png folder in exports.")
             raise
+        os.rename(tmp_path, abspath)
+        if indicator is not None:
+            discard_versions_of(fname)
+            sweep_maps()
+    else:
+        touch_map(fname)
 
     # return redirect('export', fpath=fpath)
     return serve_exported_files(request, fpath=fpath)
@@ -6,13 +6,14 @@ from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 import logging
 
-from django.http import Http404
+from django.http import Http404, StreamingHttpResponse
 from django.utils.translation import ugettext as _
 from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
 from django.conf import settings
 
 from dmd.models import Metadata
+from dmd.csvexport import get_records, iter_csv
 from dmd.models.DataRecords import DataRecord
 from dmd.models.Entities import Entity
 from dmd.models.Indicators import Indicator
@@ -78,6 +79,16 @@ def data_export(request, *args, **kwargs):
                   context)
 
 
+@login_required
+def data_export_csv(request, *args, **kwargs):
+    """ up-to-date CSV export, streamed as it is generated """
+    response = StreamingHttpResponse(iter_csv(get_records()),
+                                     content_type='text/csv')
+    file_name = settings.ALL_EXPORT_FNAME
+    response['Content-Disposition'] = 'attachment; filename="%s"' % file_name
+    return response
+
+
 @login_required
 def pivot_table(request, *args, **kwargs):
     context = {'page': 'pivot_table'}
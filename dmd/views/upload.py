@@ -45,7 +45,8 @@ def create_records_from(request, xls_data, filepath=None):
     nb_errors = nb_updated = nb_created = 0
     try:
         payload = DataRecord.batch_create(xls_data,
-                                          request.user.partner)
+                                          request.user.partner,
+                                          bulk=True)
     except Exception as e:
         payload = xls_data
         level = 'danger'
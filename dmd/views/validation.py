@@ -118,6 +118,7 @@ def validation(request, template_name='validation.html'):
                 'validated': 0,
                 'rejected': 0
             }
+            changed = []
 
             for dr in records:
                 status = form.cleaned_data.get('status-{}'.format(dr.id))
@@ -133,7 +134,7 @@ def validation(request, template_name='validation.html'):
 
                     dr.numerator = numerator
                     dr.denominator = denominator
-                    dr.record_update(request.user.partner)
+                    dr.record_update(request.user.partner, notify=False)
 
                     counts['updated'] += 1
 
@@ -148,7 +149,13 @@ def validation(request, template_name='validation.html'):
                     dr.record_validation(
                         status=status,
                         on=now,
-                        by=request.user.partner)
+                        by=request.user.partner,
+                        notify=False)
+                    changed.append(dr)
+
+            # single change event for the whole form
+            DataRecord.notify_changes(changed)
+
             messages.info(request, _(
                 "Thank You for your validations. {w} data were left "
                 "untouched, {u} were updated, {v} validated "
@@ -15,10 +15,12 @@ from openpyxl.styles import (PatternFill, Border, Side,
                              Alignment, Protection, Font)
 from openpyxl.worksheet.datavalidation import DataValidation
 from openpyxl.styles.fills import FILL_SOLID
+from openpyxl.writer.dump_worksheet import WriteOnlyCell
 
 from dmd.xlsx import column_to_letter
 from dmd.models.Entities import Entity
 from dmd.models.Indicators import Indicator
+from dmd.csvexport import iter_flat_records
 
 logger = logging.getLogger(__name__)
 
@@ -404,6 +406,11 @@ def generate_dataentry_for(dps, save_to=None):
 
 
 def export_to_spreadsheet(qs, save_to=None):
+    """ one sheet per indicator with all its records, in write-only mode
+
+        rows are flushed to disk as they are appended so memory use
+        does not depend on the number of records. Styled cells are
+        created once per sheet and reused for every row. """
 
     # colors
     black = 'FF000000'
@@ -465,23 +472,23 @@ def export_to_spreadsheet(qs, save_to=None):
         'number_format': number_format,
     }
 
-    empty = ""
+    headers = ["Année", "Mois", "DPS", "ZS", "Numérateur", "Dénominateur",
+               "Valeur", "Valeur (affich.)"]
+    col_widths = {3: 7, 4: 7, 5: 3, 6: 3, 8: 3}
 
-    col_year = 1
-    col_month = 2
-    col_dps = 3
-    col_zs = 4
-    col_numerator = 5
-    col_denominator = 6
-    col_value = 7
-    col_human = 8
+    def styled_cells(ws, style):
+        cells = [WriteOnlyCell(ws) for _ in headers]
+        for cell in cells:
+            for key, value in style.items():
+                setattr(cell, key, value)
+        return cells
 
-    def apply_style(target, style):
-        for key, value in style.items():
-            setattr(target, key, value)
+    def append(ws, cells, values):
+        for cell, value in zip(cells, values):
+            cell.value = value
+        ws.append(cells)
 
-    wb = Workbook()
-    wb.remove_sheet(wb.active)
+    wb = Workbook(write_only=True)
 
     logger.info("exporting {} records".format(qs.count()))
 
@@ -490,46 +497,17 @@ def export_to_spreadsheet(qs, save_to=None):
         ws = wb.create_sheet()
         ws.title = "#{}".format(indicator.number)
 
-        def std_write(row, column, value, style=std_style):
-            cell = ws.cell(row=row, column=column)
-            cell.value = value
-            apply_style(cell, style)
+        # must be set before the first row is written
+        for column, width in col_widths.items():
+            xl_set_col_width(ws, column, width)
 
-        row = 1
-
-        # write header
-        std_write(row, col_year, "Année", header_style)
-        std_write(row, col_month, "Mois", header_style)
-        std_write(row, col_dps, "DPS", header_style)
-        xl_set_col_width(ws, col_dps, 7)
-        std_write(row, col_zs, "ZS", header_style)
-        xl_set_col_width(ws, col_zs, 7)
-        std_write(row, col_numerator, "Numérateur", header_style)
-        xl_set_col_width(ws, col_numerator, 3)
-        std_write(row, col_denominator, "Dénominateur", header_style)
-        xl_set_col_width(ws, col_denominator, 3)
-        std_write(row, col_value, "Valeur", header_style)
-        std_write(row, col_human, "Valeur (affich.)", header_style)
-        xl_set_col_width(ws, col_human, 3)
-
-        row += 1
+        append(ws, styled_cells(ws, header_style), headers)
 
-        for record in qs.filter(indicator=indicator).iterator():
-
-            std_write(row, col_year, record.period.year, std_style)
-            std_write(row, col_month, record.period.month, std_style)
-            std_write(row, col_dps,
-                      getattr(record.entity.get_dps(), 'short_name', empty),
-                      std_style)
-            std_write(row, col_zs,
-                      getattr(record.entity.get_zs(), 'short_name', empty),
-                      std_style)
-            std_write(row, col_numerator, record.numerator, std_style)
-            std_write(row, col_denominator, record.denominator, std_style)
-            std_write(row, col_value, record.value, std_style)
-            std_write(row, col_human, record.human(), std_style)
-
-            row += 1
+        cells = styled_cells(ws, std_style)
+        for year, month, _, dps, zs, numerator, denominator, value, human \
+                in iter_flat_records(qs.filter(indicator=indicator)):
+            append(ws, cells, [year, month, dps, zs,
+                               numerator, denominator, value, human])
 
     if save_to:
         logger.info("saving to {}".format(save_to))